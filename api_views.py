@@ -1,20 +1,27 @@
+import asyncio
 import logging
 import uuid
-from aiohttp import WSCloseCode
-from aiohttp.web import json_response, Request, Response
+from functools import partial
+from aiohttp import WSCloseCode, web
+from aiohttp.web import Request, Response
 from aiohttp.web_exceptions import HTTPBadRequest
 from aiohttp.web_ws import WebSocketResponse
 from rororo import openapi_context, OperationTableDef
 from rororo.openapi import ValidationError, BasicInvalidCredentials
-from sqlalchemy import select, delete
-from sqlalchemy.exc import NoResultFound
+from sqlalchemy import select, delete, update, func
+from sqlalchemy.exc import IntegrityError
 
 import db
+import json_codec
 from lobby import Lobby
 from auth import Auth, jwt_auth
+from profile_cache import profiles
 
 logger = logging.getLogger(__name__)
 operations = OperationTableDef()
+json_response = partial(web.json_response, dumps=json_codec.dumps)
+
+SAVED_CHATS_PAGE_SIZE = 50
 
 
 @operations.register("signUp")
@@ -64,11 +71,16 @@ async def login(request: Request) -> Response:
 @jwt_auth
 async def start_search(request: Request) -> Response:
     user_id = request["user_id"]
+    with openapi_context(request) as context:
+        tags = context.parameters.query.get("tags", "").split(",")
     try:
-        chat_id = await request.app["lobby"].start_search_and_wait(user_id)
+        chat_id = await request.app["lobby"].start_search_and_wait(user_id, tags)
     except Lobby.AlreadySearchingError:
         logger.error("USER %s WAS ALREADY SEARCHING", user_id)
         raise ValidationError(message="Already searching")
+    except Lobby.SearchTimeoutError:
+        logger.info("TO USER %s: CHAT NOT FOUND (TIMED OUT)", user_id)
+        raise ValidationError(message="Search has timed out")
 
     if chat_id is None:
         logger.info("TO USER %s: CHAT NOT FOUND (ABORTED)", user_id)
@@ -81,6 +93,62 @@ async def start_search(request: Request) -> Response:
     return json_response({"chat_id": chat_id})
 
 
+@operations.register("searchChat")
+async def search_chat(request: Request) -> Response:
+    with openapi_context(request) as context:
+        tags = context.parameters.query.get("tags", "").split(",")
+
+    # Upgrade connection to websocket
+    ws = WebSocketResponse()
+    try:
+        await ws.prepare(request)
+    except HTTPBadRequest:
+        logger.error("BAD HTTP REQUEST FOR WEBSOCKET")
+        raise ValidationError(message="Websocket connection is required")
+
+    user_id = await authenticate_websocket(ws)
+    if user_id is None:
+        return Response()
+
+    # Search until matched, any frame from the client or its disconnect aborts the search
+    search = asyncio.create_task(request.app["lobby"].start_search_and_wait(user_id, tags))
+    client_frame = asyncio.create_task(ws.receive())
+    await asyncio.wait({search, client_frame}, return_when=asyncio.FIRST_COMPLETED)
+    client_frame.cancel()
+
+    if not search.done():
+        search.cancel()
+        logger.info("USER %s ABORTED CHAT SEARCH VIA WEBSOCKET", user_id)
+        await ws.close()
+        return Response()
+
+    try:
+        chat_id = search.result()
+    except Lobby.AlreadySearchingError:
+        logger.error("USER %s WAS ALREADY SEARCHING", user_id)
+        await ws.close(code=WSCloseCode.POLICY_VIOLATION, message="Already searching".encode("utf-8"))
+        return Response()
+    except Lobby.SearchTimeoutError:
+        logger.info("TO USER %s: CHAT NOT FOUND (TIMED OUT)", user_id)
+        await ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message="Search has timed out".encode("utf-8"))
+        return Response()
+    except Exception:
+        # Websocket is already prepared, so the error is reported by the close code, and the search is withdrawn
+        logger.exception("SEARCH OF USER %s FAILED", user_id)
+        try:
+            request.app["lobby"].abort_search(user_id)
+        except Lobby.WasNotSearchingError:
+            pass
+        await ws.close(code=WSCloseCode.INTERNAL_ERROR, message="Search has failed".encode("utf-8"))
+        return Response()
+
+    logger.info("TO USER %s: SENDING CHAT %s", user_id, chat_id)
+    await ws.send_json({"chat_id": (chat_id.hex if chat_id else None)}, dumps=json_codec.dumps)
+    await ws.close()
+
+    return Response()
+
+
 @operations.register("abortSearch")
 @jwt_auth
 async def abort_search(request: Request) -> Response:
@@ -101,24 +169,69 @@ async def abort_search(request: Request) -> Response:
 @jwt_auth
 async def get_saved_chats(request: Request) -> Response:
     user_id = request["user_id"]
+    with openapi_context(request) as context:
+        limit = context.parameters.query.get("limit", SAVED_CHATS_PAGE_SIZE)
+        after = context.parameters.query.get("after")
+        with_last_message = context.parameters.query.get("with_last_message", False)
+    try:
+        after = (uuid.UUID(after) if after else None)
+    except ValueError:
+        logger.error("Invalid cursor!")
+        raise ValidationError(message="Invalid cursor")
+
+    # Keyset pagination by chat_id, served by the covering index on (user_id, chat_id)
+    query = (select(db.SavedChat.chat_id, db.SavedChat.title, db.SavedChat.offset)
+             .filter(db.SavedChat.user_id == user_id)
+             .order_by(db.SavedChat.chat_id)
+             .limit(limit))
+    if after is not None:
+        query = query.filter(db.SavedChat.chat_id > after)
 
-    query = select(db.SavedChat).filter_by(user_id=user_id)
     async with db.get_session(request) as session:
         result = await session.execute(query)
-        chats = result.scalars().all()
-
-    return json_response({
-        chat.chat_id.hex: {
-            "title": chat.title,
-        }
-        for chat in chats
-    })
+        chats = result.all()
+        summaries = (await get_chat_summaries(session, [chat.chat_id for chat in chats])
+                     if with_last_message and chats else {})
+
+    response = {}
+    for chat in chats:
+        info = response[chat.chat_id.hex] = {"title": chat.title}
+        summary = summaries.get(chat.chat_id)
+        if with_last_message and summary is not None:
+            info["message_count"] = summary.message_count
+            info["unread"] = max(summary.message_id - chat.offset, 0)
+            info["last_message"] = {
+                "message_id": summary.message_id,
+                "from": ("YOU" if summary.user_id == user_id else "ANON"),
+                "text": summary.text,
+            }
+
+    headers = ({"X-Next-Cursor": chats[-1].chat_id.hex} if len(chats) == limit else None)
+    return json_response(response, headers=headers)
+
+
+async def get_chat_summaries(session, chat_ids):
+    """ Returns message count and last message of every chat, all of them are computed by a single query """
+    counts = (select(db.Message.chat_id,
+                     func.count().label("message_count"),
+                     func.max(db.Message.message_id).label("last_message_id"))
+              .filter(db.Message.chat_id.in_(chat_ids))
+              .group_by(db.Message.chat_id)
+              .subquery())
+    query = (select(counts.c.chat_id, counts.c.message_count,
+                    db.Message.message_id, db.Message.user_id, db.Message.text)
+             .join(db.Message, (db.Message.chat_id == counts.c.chat_id)
+                   & (db.Message.message_id == counts.c.last_message_id)))
+    result = await session.execute(query)
+    return {row.chat_id: row for row in result.all()}
 
 
 @operations.register("joinChat")
 async def join_chat(request: Request) -> Response:
     with openapi_context(request) as context:
         chat_id = context.parameters.path["chat_id"]
+        last_message_id = context.parameters.query.get("last_message_id")
+        limit = context.parameters.query.get("limit")
     try:
         chat_id = uuid.UUID(chat_id)
     except ValueError:
@@ -139,7 +252,7 @@ async def join_chat(request: Request) -> Response:
 
     # Obtain chat instance
     lobby = request.app["lobby"]
-    chat = await lobby.get_chat(request, chat_id)
+    chat = await lobby.get_chat(chat_id)
     if not chat:
         logger.error("CHAT %s NOT FOUND", chat_id)
         await ws.close(code=WSCloseCode.UNSUPPORTED_DATA, message="Chat not found".encode("utf-8"))
@@ -147,21 +260,14 @@ async def join_chat(request: Request) -> Response:
 
     logging.info("CHAT %s FOUND, WAITING FOR TOKEN...", chat_id)
 
-    # Receive token from websocket
-    token = await ws.receive_str()
-
-    # Validate and obtain user_id from it
-    try:
-        user_id = Auth.verify(token)
-    except Auth.InvalidToken:
-        logger.error("INVALID JWT TOKEN: %s", token)
-        await ws.close(code=WSCloseCode.UNSUPPORTED_DATA, message="Invalid JWT token".encode("utf-8"))
+    user_id = await authenticate_websocket(ws)
+    if user_id is None:
         return Response()
 
     logger.info("CONFIRMED TOKEN, IT IS USER %s, PROCEED...", user_id)
 
     # Perform chatting until exited
-    await lobby.proceed_with_chat(chat, user_id, ws)
+    await lobby.proceed_with_chat(chat, user_id, ws, last_message_id=last_message_id, limit=limit)
 
     return Response()
 
@@ -185,15 +291,14 @@ async def save_chat(request: Request) -> Response:
         raise ValidationError(message="Invalid chat_id")
 
     # Obtain chat instance
-    chat = await request.app["lobby"].get_chat(request, chat_id)
+    chat = await request.app["lobby"].get_chat(chat_id)
     if not chat:
         logger.error("CHAT %s NOT FOUND", chat_id)
         raise ValidationError(message="Chat not found")
 
     # Save chat
     async with db.get_session(request) as session:
-        await chat.save(db.get_session(request), user_id, title)
-        await session.commit()
+        await chat.save(session, user_id, title)
 
     return json_response()
 
@@ -205,7 +310,7 @@ async def get_public_user_info(request: Request) -> Response:
 
     # Get profile info
     async with db.get_session(request) as session:
-        user = await get_user(session, username=username)
+        user = await get_profile(session, username=username)
     displayed_name = user.displayed_name
 
     # Send profile data to the user
@@ -221,7 +326,7 @@ async def get_all_user_info(request: Request) -> Response:
 
     # Get profile data
     async with db.get_session(request) as session:
-        user = await get_user(session, user_id=user_id)
+        user = await get_profile(session, user_id=user_id)
     displayed_name = user.displayed_name
     username = user.username
 
@@ -249,23 +354,29 @@ async def modify_all_user_info(request: Request) -> Response:
         except KeyError:
             raise ValidationError(message="Wrong body schema")
 
+    # Change profile data in a single statement, username conflicts are caught by the unique constraint
+    old = (select(db.User.user_id, db.User.username)
+           .filter_by(user_id=user_id)
+           .with_for_update()
+           .subquery())
+    query = (update(db.User)
+             .where(db.User.user_id == old.c.user_id)
+             .values(displayed_name=displayed_name, username=username)
+             .returning(old.c.username))
     async with db.get_session(request) as session:
-        # Obtain user
-        user = await get_user(session, user_id=user_id)
-
-        if username != user.username:
-            # Prevent username conflict
-            try:
-                await get_user(session, username=username)
-            except ValidationError:
-                pass
-            else:
-                raise ValidationError(message="Username is taken")
-
-        # Change profile data
-        user.displayed_name = displayed_name
-        user.username = username
-        await session.commit()
+        try:
+            old_username = (await session.execute(query)).scalar_one_or_none()
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            logger.error("USERNAME %s IS TAKEN", username)
+            raise ValidationError(message="Username is taken")
+
+    if old_username is None:
+        logger.error("USER IS NOT FOUND!")
+        raise ValidationError(message="User not found")
+
+    request.app["lobby"].invalidate_user(user_id, old_username, username)
 
     return json_response()
 
@@ -283,13 +394,15 @@ async def delete_user(request: Request) -> Response:
             raise ValidationError(message="User not found")
         await session.commit()
 
+    request.app["lobby"].invalidate_user(user_id, deleted=True)
+
     return json_response()
 
 
 @operations.register("clearLobby")
 async def clear_lobby(request: Request) -> Response:
     await disconnect_all(request.app)
-    print("\n\n\n\t\tLOBBY CLEARED\n\n\n", flush=True)
+    logger.warning("LOBBY CLEARED")
     return Response(text="LOBBY CLEARED")
 
 
@@ -299,22 +412,43 @@ async def clear_db(request: Request) -> Response:
         query = delete(db.User)
         await session.execute(query)
         await session.commit()
-    print("\n\n\n\t\tDB CLEARED\n\n\n", flush=True)
+    request.app["lobby"].invalidate_all_users()
+    logger.warning("DB CLEARED")
     return Response(text="DB CLEARED")
 
 
-async def get_user(session, **filter_kwargs):
-    query = select(db.User).filter_by(**filter_kwargs)
+async def authenticate_websocket(ws):
+    """ Receives token as the first frame, returns user_id or closes websocket and returns None """
+    # Receive token from websocket
     try:
-        result = await session.execute(query)
-        user = result.scalar_one()
-    except NoResultFound:
+        token = await ws.receive_str()
+    except TypeError:
+        logger.error("TOKEN WAS NOT RECEIVED")
+        await ws.close(code=WSCloseCode.UNSUPPORTED_DATA, message="Token is required".encode("utf-8"))
+        return None
+
+    # Validate and obtain user_id from it
+    try:
+        user_id = Auth.verify(token)
+    except Auth.InvalidToken:
+        logger.error("INVALID JWT TOKEN: %s", token)
+        await ws.close(code=WSCloseCode.UNSUPPORTED_DATA, message="Invalid JWT token".encode("utf-8"))
+        return None
+
+    return user_id
+
+
+async def get_profile(session, user_id=None, username=None):
+    profile = await profiles.get(session, user_id=user_id, username=username)
+    if profile is None:
         logger.error("USER IS NOT FOUND!")
         raise ValidationError(message="User not found")
-    return user
+    return profile
 
 
 async def disconnect_all(app):
+    """ Aborts searches and closes chat websockets, so their handlers save read offsets and notify the peers """
     lobby = app["lobby"]
-    if lobby.pending is not None:
-        lobby.abort_search(lobby.pending.user_id)
+    lobby.abort_all_searches()
+    await lobby.flush_all()
+    await lobby.close_all_chats(WSCloseCode.GOING_AWAY, "Server is shutting down")
@@ -1,17 +1,29 @@
 import logging
+import time
 import jwt
 import uuid
+from os import getenv
 from rororo.openapi import BasicSecurityError
 from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import NoResultFound
     
 import db
+import metrics
+import tracing
+from cache import LRUCache
+from passwords import PasswordHasher
 
 logger = logging.getLogger(__name__)
 
 
 class Auth:
     JWT_SECRET = "SwApChAd"
+    TOKEN_CACHE_SIZE = int(getenv("TOKEN_CACHE_SIZE", 10000))
+    TOKEN_CACHE_TTL = float(getenv("TOKEN_CACHE_TTL", 300))
+
+    verified_tokens = LRUCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+    hasher = PasswordHasher()
 
     class UsernameIsTakenError(Exception):
         pass
@@ -24,22 +36,23 @@ class Auth:
 
     @staticmethod
     async def signup(session, username, password, displayed_name):
-        """ Registers user in the DB and performs login (returning token) """
-        # Is the username free?
-        if (await session.execute(select(db.User).filter_by(username=username))).first():
+        """ Registers user in the DB and returns login token """
+        # Create new user, unless the username is taken
+        query = (insert(db.User)
+                 .values(user_id=uuid.uuid4(),
+                         username=username,
+                         password=await Auth.hasher.hash(password),
+                         displayed_name=displayed_name)
+                 .on_conflict_do_nothing(index_elements=[db.User.username])
+                 .returning(db.User.user_id))
+        user_id = (await session.execute(query)).scalar_one_or_none()
+        if user_id is None:
             logger.error("USERNAME %s IS TAKEN", username)
             raise Auth.UsernameIsTakenError()
-
-        # If yes, create new user
-        new_user = db.User(user_id=uuid.uuid4(),
-                           username=username,
-                           password=password,
-                           displayed_name=displayed_name)
-        session.add(new_user)
         await session.commit()
 
-        # And perform login
-        return await Auth.login(session, username, password)
+        # Password has just been hashed, so there is no need to verify it again
+        return Auth.issue_token(user_id)
 
     @staticmethod
     async def login(session, username, password):
@@ -50,27 +63,54 @@ class Auth:
         except NoResultFound:
             logger.error("WRONG CREDENTIALS (NO SUCH USER)")
             raise Auth.WrongCredentials()
-        if password != user.password:
+        matches, needs_rehash = await Auth.hasher.verify(user.password, password)
+        if not matches:
             logger.error("WRONG CREDENTIALS (PASSWORDS MISMATCH)")
             raise Auth.WrongCredentials()
 
+        # Plaintext or outdated hashes are replaced transparently
+        if needs_rehash:
+            user.password = await Auth.hasher.hash(password)
+            await session.commit()
+            logger.info("PASSWORD HASH OF USER %s WAS UPGRADED", user.user_id)
+
         # If yes, encode user_id into JWT token and send it to the client
+        return Auth.issue_token(user.user_id)
+
+    @staticmethod
+    def issue_token(user_id):
         jwt_payload = {
-            'user_id': user.user_id.hex
+            'user_id': user_id.hex
         }
         return jwt.encode(jwt_payload, Auth.JWT_SECRET, algorithm="HS256")
 
     @staticmethod
     def verify(jwt_token):
-        """ Decodes JWT Bearer token and returns user_id from its payload """
+        """ Decodes JWT Bearer token and returns user_id from its payload, recently verified tokens are cached """
+        user_id = Auth.verified_tokens.get(jwt_token)
+        if user_id is not None:
+            return user_id
+
         try:
             jwt_payload = jwt.decode(jwt_token, Auth.JWT_SECRET, algorithms=["HS256"])
             user_id = uuid.UUID(jwt_payload['user_id'])
         except (jwt.InvalidTokenError, KeyError, ValueError) as exc:
             logger.error("INVALID TOKEN: %s", jwt_token)
             raise Auth.InvalidToken() from exc
+
+        # Token must not outlive its expiration time in the cache
+        ttl = (jwt_payload["exp"] - time.time() if "exp" in jwt_payload else None)
+        Auth.verified_tokens.set(jwt_token, user_id, ttl=ttl)
         return user_id
 
+    @staticmethod
+    def invalidate_user(user_id):
+        """ Forgets cached tokens of the user, so they are fully verified next time """
+        Auth.verified_tokens.remove_if(lambda cached_user_id: cached_user_id == user_id)
+
+
+metrics.registry.collector("swapchad_token_cache", Auth.verified_tokens.get_stats)
+
 
 def jwt_auth(handler):
     """ Wrapper for request handlers, validates JWS Bearer token and adds extracted user_id to the request dict """
@@ -82,7 +122,8 @@ def jwt_auth(handler):
             raise BasicSecurityError(message="Missing JWT Bearer token")
 
         try:
-            user_id = Auth.verify(jwt_token)
+            with tracing.span("jwt"):
+                user_id = Auth.verify(jwt_token)
         except Auth.InvalidToken:
             raise BasicSecurityError(message="Invalid JWT token")
 
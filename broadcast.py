@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from os import getenv
+
+from aiohttp import WSCloseCode
+
+import metrics
+from message_store import MessageStore
+
+logger = logging.getLogger(__name__)
+
+delivery_latency = metrics.registry.histogram("swapchad_broadcast_delivery_seconds",
+                                              "Time a frame spends in the outbox until it is sent to the client")
+
+
+class BroadcastStats:
+    """ Send counters of a single chat """
+    def __init__(self):
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+        self.send_seconds = 0.0
+        self.max_send_seconds = 0.0
+
+    def record_send(self, seconds):
+        self.sent += 1
+        self.send_seconds += seconds
+        self.max_send_seconds = max(self.max_send_seconds, seconds)
+
+    def as_dict(self):
+        return {
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "disconnected": self.disconnected,
+            "avg_send_seconds": (self.send_seconds / self.sent if self.sent else 0),
+            "max_send_seconds": self.max_send_seconds,
+        }
+
+
+class Outbox:
+    """ Bounded queue of outgoing frames of a single client, drained by its own writer task """
+    DROP = "drop"
+    COALESCE = "coalesce"
+    DISCONNECT = "disconnect"
+
+    # Coalesced messages are tagged, so they can't be confused with a message looking like a JSON array
+    BATCH = "\0BATCH"
+
+    MAX_SIZE = int(getenv("OUTBOX_MAX_SIZE", 256))
+    POLICY = getenv("OUTBOX_POLICY", DROP)
+
+    def __init__(self, ws, stats, policy=None, max_size=None):
+        self.ws = ws
+        self.stats = stats
+        self.policy = policy or self.POLICY
+        self.max_size = max_size or self.MAX_SIZE
+        self.frames = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.too_slow = False
+        self.task = asyncio.create_task(self.run())
+
+    def __len__(self):
+        return len(self.frames)
+
+    def send(self, frame):
+        """ Queues text frame without waiting for it to be sent, slow consumers are handled by the policy """
+        self.enqueue(frame, None)
+
+    def send_message(self, message_id, text):
+        """ Queues chat message of the other user, queued messages may be coalesced into a single history frame """
+        self.enqueue(text, [(message_id, text)])
+
+    def enqueue(self, frame, messages):
+        if self.closed:
+            self.stats.dropped += 1
+        elif len(self.frames) < self.max_size:
+            self.frames.append((frame, time.perf_counter(), messages))
+            self.ready.set()
+        elif self.policy == self.COALESCE:
+            # Only plain messages are merged, history and notification frames must reach the client as they are
+            last_messages = self.frames[-1][2]
+            if messages is not None and last_messages is not None:
+                last_messages += messages
+                self.stats.coalesced += 1
+            else:
+                self.stats.dropped += 1
+        elif self.policy == self.DISCONNECT:
+            # The writer task closes the websocket, then the chat removes the client the usual way
+            logger.warning("OUTBOX IS FULL (%d FRAMES), DISCONNECTING SLOW CLIENT", len(self.frames))
+            self.stats.disconnected += 1
+            self.closed = self.too_slow = True
+            self.frames.clear()
+            self.ready.set()
+        else:
+            self.stats.dropped += 1
+
+    async def run(self):
+        while True:
+            while not self.frames and not self.closed:
+                self.ready.clear()
+                await self.ready.wait()
+            if self.too_slow:
+                await self.close_websocket(WSCloseCode.TRY_AGAIN_LATER, "Too slow")
+                return
+            if self.closed:
+                return
+            frame, queued_at, messages = self.frames.popleft()
+            if messages is not None and len(messages) > 1:
+                frame = self.encode_messages(messages)
+            try:
+                await self.ws.send_str(frame)
+            except Exception as e:
+                # Closing the websocket ends the reading loop of the chat, which removes the client
+                logger.warning("FAILED TO SEND FRAME, CLOSING WEBSOCKET: %s", e)
+                self.closed = True
+                self.frames.clear()
+                await self.close_websocket(WSCloseCode.INTERNAL_ERROR, "Send failed")
+                return
+            seconds = time.perf_counter() - queued_at
+            self.stats.record_send(seconds)
+            delivery_latency.observe(seconds)
+
+    async def close_websocket(self, code, message):
+        try:
+            await self.ws.close(code=code, message=message.encode("utf-8"))
+        except Exception:
+            logger.exception("FAILED TO CLOSE WEBSOCKET")
+
+    @classmethod
+    def encode_messages(cls, messages):
+        """ Coalesced messages of the other user are encoded like the history, after the BATCH tag """
+        view = MessageStore.View(lambda _author: False)
+        for message_id, text in messages:
+            view.append(message_id, None, text)
+        return cls.BATCH + view.frame(0, len(messages))
+
+    def close(self):
+        """ Stops the writer task, frames which are still queued are discarded """
+        self.closed = True
+        self.frames.clear()
+        self.task.cancel()
@@ -0,0 +1,62 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ Bounded mapping with least recently used eviction and per-entry expiration """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        return None if entry is None else entry[0]
+
+    def remove_if(self, predicate):
+        """ Removes all entries, which values match the predicate """
+        for key in [key for key, (value, _) in self.entries.items() if predicate(value)]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups if lookups else 0),
+            "evictions": self.evictions,
+        }
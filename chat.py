@@ -1,88 +1,257 @@
 from aiohttp import WSMsgType
+import asyncio
+from os import getenv
 import logging
+import time
 
-from sqlalchemy import select
+from sqlalchemy import insert, select
 
 import db
+import metrics
+from broadcast import BroadcastStats, Outbox
+from message_buffer import MessageBuffer
+from message_store import MessageStore
 
 logger = logging.getLogger(__name__)
 
+fanout_latency = metrics.registry.histogram("swapchad_broadcast_fanout_seconds",
+                                            "Time to queue a message for the other clients of the chat")
+
 
 class Chat:
-    def __init__(self, chat_id):
+    # Frames starting with \0 are control frames, such frames are never relayed as messages
+    CONTROL_PREFIX = "\0"
+    HISTORY_REQUEST = "\0HISTORY"
+    MESSAGE_TOO_LONG = "MESSAGE IS TOO LONG"
+    NOT_DELIVERED = "MESSAGE WAS NOT DELIVERED"
+    MAX_HISTORY_PAGE = int(getenv("MAX_HISTORY_PAGE", 500))
+    LOAD_PAGE_SIZE = int(getenv("SAVED_CHAT_PAGE_SIZE", 100))
+    SAVE_CHUNK_SIZE = int(getenv("SAVE_CHUNK_SIZE", 10000))
+
+    def __init__(self, chat_id, session_factory):
         self.chat_id = chat_id
+        self.session_factory = session_factory
         self.clients = dict()
-        self.messages = []
+        self.messages = MessageStore()
+        self.first_loaded_id = 1
         self.last_message_id = 0
         self.saved_by = set()
-        self.saving_session = None
+        self.buffer = None
+        self.save_lock = asyncio.Lock()
+        self.broadcast_stats = BroadcastStats()
+        self.cluster = None
+        self.is_home = True
 
     @staticmethod
-    async def try_load_saved(session, chat_id):
-        query = select(db.Message).filter_by(chat_id=chat_id)
-        result = await session.execute(query)
-        messages = result.scalars().all()
+    async def try_load_saved(session_factory, chat_id):
+        """ Loads saved chat with only the newest page of its messages, older ones are fetched on demand """
+        async with session_factory() as session:
+            result = await session.execute(Chat.select_page(chat_id, limit=Chat.LOAD_PAGE_SIZE))
+            rows = result.all()
 
-        if not messages:
+        if not rows:
             return None
 
-        new_chat = Chat(chat_id)
-        new_chat.messages = [
-            Chat.Message(message_id=message.message_id,
-                         from_id=message.user_id,
-                         text=message.text)
-            for message in messages
-        ]
-        if messages:
-            new_chat.last_message_id = messages[-1].message_id
-        new_chat.saving_session = session
+        new_chat = Chat(chat_id, session_factory)
+        new_chat.messages = MessageStore.from_rows(reversed(rows))
+        new_chat.first_loaded_id = rows[-1].message_id
+        new_chat.last_message_id = rows[0].message_id
+        new_chat.buffer = MessageBuffer(chat_id, session_factory, persisted_id=new_chat.last_message_id)
         return new_chat
 
+    @staticmethod
+    def select_page(chat_id, after_id=0, before_id=None, limit=None):
+        """ Keyset query for the newest messages between the cursors, rows are (message_id, user_id, text) """
+        query = (select(db.Message.message_id, db.Message.user_id, db.Message.text)
+                 .filter(db.Message.chat_id == chat_id, db.Message.message_id > after_id))
+        if before_id is not None:
+            query = query.filter(db.Message.message_id < before_id)
+        return query.order_by(db.Message.message_id.desc()).limit(limit)
+
     async def save(self, session, by_id, title):
-        if self.saved_by:
-            instance = await self.try_load_saved_instance(session, by_id)
-            if instance:
-                instance.title = title
+        """ Saves chat for the user and commits the session, the whole history is written by the first save """
+        # Chat becomes saved only once the history is committed, concurrent first saves wait for each other
+        async with self.save_lock:
+            if self.buffer is not None:
+                instance = await self.try_load_saved_instance(session, by_id)
+                if instance:
+                    instance.title = title
+                else:
+                    self.save_instance(session, by_id, title)
+                await session.commit()
+
             else:
+                persisted_id = self.last_message_id
                 self.save_instance(session, by_id, title)
 
-        else:
-            self.saving_session = session
-            self.save_instance(session, by_id, title)
+                # Whole history is written by executemany within the same transaction
+                rows = [
+                    {"chat_id": self.chat_id, "message_id": message_id, "user_id": from_id, "text": text}
+                    for message_id, from_id, text in self.messages
+                ]
+                for start in range(0, len(rows), self.SAVE_CHUNK_SIZE):
+                    await session.execute(insert(db.Message.__table__), rows[start:start + self.SAVE_CHUNK_SIZE])
+                await session.commit()
+
+                # Messages, which arrived while the history was being written, are persisted by the buffer
+                self.mark_saved(persisted_id)
+                if self.cluster is not None:
+                    self.cluster.publish_saved(self.chat_id, persisted_id)
+
+        self.saved_by.add(by_id)
 
-            for message in self.messages:
-                message.save(session, self.chat_id)
+    def mark_saved(self, persisted_id):
+        """ Starts persisting messages of the chat, which was saved by another instance """
+        if self.buffer is not None:
+            return
+        self.buffer = MessageBuffer(self.chat_id, self.session_factory, persisted_id=persisted_id)
+        if self.is_home:
+            for message_id, from_id, text in self.messages.rows(self.messages.index_after(persisted_id)):
+                self.buffer.push(self.Message(message_id, from_id, text))
 
-            self.saved_by.add(by_id)
+    async def flush(self):
+        """ Writes messages, which are still waiting in the buffer, to the DB """
+        if self.buffer is not None:
+            await self.buffer.flush()
 
-    async def proceed(self, user_id, ws):
-        self.clients[user_id] = ws
+    def is_flushed(self):
+        return self.buffer is None or not (self.buffer.pending or self.buffer.offsets)
 
-        # Send messages to user
-        logger.info("CHAT %s: SENDING MESSAGES (%d) TO USER %s\n...", self.chat_id, len(self.messages), user_id)
-        await ws.send_json([message.raw_from_user_perspective(user_id) for message in self.messages])
+    async def unload(self):
+        """ Flushes the chat before it is dropped from memory, home instance hands the chat over to replicas """
+        await self.flush()
+        if self.cluster is not None and self.is_home:
+            self.cluster.release(self.chat_id)
 
-        logger.info("CHAT %s: MESSAGES SENT, WAITING FOR UPDATES FROM USER %s\n...", self.chat_id, user_id)
+    async def proceed(self, user_id, ws, last_message_id=None, limit=None):
+        # Send messages, which the user has not seen yet, to the user
+        count, frame = await self.fetch_history(user_id, after_id=last_message_id, limit=limit)
+        outbox = Outbox(ws, self.broadcast_stats)
+        self.clients[user_id] = outbox
+        logger.info("CHAT %s: SENDING MESSAGES (%d) TO USER %s\n...", self.chat_id, count, user_id)
+        outbox.send(frame)
+
+        logger.info("CHAT %s: MESSAGES QUEUED, WAITING FOR UPDATES FROM USER %s\n...", self.chat_id, user_id)
 
         # Handle updates from the user until websocket disconnects
         try:
             async for update in ws:
-                if update.type == WSMsgType.TEXT:
+                if update.type == WSMsgType.TEXT and update.data.startswith(self.HISTORY_REQUEST):
+                    await self.handle_history_request(user_id, outbox, update.data)
+                elif update.type == WSMsgType.TEXT and update.data.startswith(self.CONTROL_PREFIX):
+                    logger.warning("CHAT %s: USER %s SENT UNKNOWN CONTROL FRAME", self.chat_id, user_id)
+                elif update.type == WSMsgType.TEXT:
                     await self.handle_update(user_id, update.data)
                 else:
                     logger.warning("CHAT %s: USER %s SENT NON-TEXT MESSAGE: ", user_id, str(update.data))
-        except Exception as e:
-            print("WS EXC: " + str(e))
+        except Exception:
+            logger.exception("CHAT %s: WEBSOCKET OF USER %s FAILED", self.chat_id, user_id)
+        finally:
+            # Websocket was closed or the handler was cancelled, removing user from the chat
+            self.remove_client(user_id, outbox)
 
-        # Websocket was closed, removing user from the chat
+    def remove_client(self, user_id, outbox):
         del self.clients[user_id]
+        outbox.close()
+        self.messages.drop_view(user_id)
+        if self.buffer is not None:
+            self.buffer.set_offset(user_id, self.last_message_id)
         logger.info("CHAT %s: USER %s HAD LEFT", self.chat_id, user_id)
-        for other_user_id, other_ws in self.clients.items():
-            logger.info("CHAT %s: \tNOTIFYING USER %s", self.chat_id, user_id)
-            await other_ws.send_str("ANON HAD LEFT")
+        self.notify_left(user_id)
+        if self.cluster is not None:
+            self.cluster.publish_left(self.chat_id, user_id)
+
+    async def close_clients(self, code, message):
+        """ Closes websockets of the chat, so their handlers leave the chat the usual way """
+        await asyncio.gather(*(outbox.ws.close(code=code, message=message.encode("utf-8"))
+                               for outbox in list(self.clients.values())),
+                             return_exceptions=True)
+
+    def notify_left(self, user_id):
+        for other_user_id, other_outbox in self.clients.items():
+            if other_user_id != user_id:
+                logger.info("CHAT %s: \tNOTIFYING USER %s", self.chat_id, other_user_id)
+                other_outbox.send("ANON HAD LEFT")
         logger.info("CHAT %s: NOTIFIED ALL OTHER USERS", self.chat_id)
 
+    def notify_sender(self, user_id, notice):
+        outbox = self.clients.get(user_id)
+        if outbox is not None:
+            outbox.send(notice)
+
+    async def fetch_history(self, user_id, after_id=None, before_id=None, limit=None):
+        """ Returns count and JSON frame of messages between the cursors, loads ones not kept in memory from the DB """
+        start, end = self.get_history_range(after_id=after_id, before_id=before_id, limit=limit)
+
+        # Are there any requested messages older than the ones in memory?
+        unloaded_after_id = after_id or 0
+        unloaded_before_id = min(before_id or self.first_loaded_id, self.first_loaded_id)
+        if (self.buffer is None or unloaded_before_id - unloaded_after_id <= 1
+                or limit is not None and end - start >= limit):
+            return end - start, self.messages.encode(user_id, start, end)
+
+        query = self.select_page(self.chat_id, after_id=unloaded_after_id, before_id=unloaded_before_id,
+                                 limit=(None if limit is None else limit - (end - start)))
+        async with self.session_factory() as session:
+            result = await session.execute(query)
+            rows = result.all()
+
+        # New messages might have arrived while waiting for the DB
+        start, end = self.get_history_range(after_id=after_id, before_id=before_id, limit=limit)
+        messages = MessageStore.from_rows(reversed(rows))
+        messages.extend(self.messages.slice(start, end))
+        if limit is not None:
+            messages = messages.slice(-limit, None)
+        return len(messages), messages.encode(user_id)
+
+    def get_history_range(self, after_id=None, before_id=None, limit=None):
+        """ Returns [start, end) range of messages in memory between the cursors, only the latest if limit is set """
+        start = 0
+        end = len(self.messages)
+        if after_id is not None:
+            start = self.messages.index_after(after_id)
+        if before_id is not None:
+            end = self.messages.index_before(before_id)
+        if limit is not None:
+            start = max(start, end - limit)
+        return start, end
+
+    async def handle_history_request(self, user_id, outbox, request):
+        """ Sends page of older messages tagged as the request "\\0HISTORY <before_message_id> [<limit>]" """
+        try:
+            _, before_id, *limit = request.split()
+            before_id = int(before_id)
+            limit = min(int(limit[0]) if limit else self.MAX_HISTORY_PAGE, self.MAX_HISTORY_PAGE)
+        except ValueError:
+            logger.warning("CHAT %s: USER %s SENT MALFORMED HISTORY REQUEST", self.chat_id, user_id)
+            return
+
+        count, frame = await self.fetch_history(user_id, before_id=before_id, limit=limit)
+        logger.info("CHAT %s: SENDING OLDER MESSAGES (%d) TO USER %s", self.chat_id, count, user_id)
+        outbox.send(self.HISTORY_REQUEST + frame)
+
+    def trim(self, keep):
+        """ Drops messages, which are already in the DB, from memory except for the latest ones """
+        if self.buffer is None:
+            return 0
+        persisted = self.messages.index_after(self.buffer.persisted_id)
+        cut = min(persisted, len(self.messages) - keep)
+        if cut <= 0:
+            return 0
+        self.messages.drop_first(cut)
+        self.first_loaded_id = (self.messages.ids[0] if self.messages else self.last_message_id + 1)
+        return cut
+
+    def get_broadcast_stats(self):
+        """ Returns send counters of the chat along with outgoing queue depth of each client """
+        return {
+            **self.broadcast_stats.as_dict(),
+            "queue_depth": {user_id.hex: len(outbox) for user_id, outbox in self.clients.items()},
+        }
+
     class Message:
+        __slots__ = ("message_id", "from_id", "text")
+
         def __init__(self, message_id, from_id, text):
             self.message_id = message_id
             self.from_id = from_id
@@ -95,32 +264,59 @@ class Chat:
                 "text": self.text,
             }
 
-        def save(self, session, chat_id):
-            new_message = db.Message(chat_id=chat_id,
-                                     message_id=self.message_id,
-                                     user_id=self.from_id,
-                                     text=self.text)
-            session.add(new_message)
+        def row(self, chat_id):
+            return {
+                "chat_id": chat_id,
+                "message_id": self.message_id,
+                "user_id": self.from_id,
+                "text": self.text,
+            }
 
     async def handle_update(self, from_id, text):
-        logger.info("CHAT %s: HANDLING INCOMING MESSAGE FROM USER %s...", self.chat_id, from_id)
+        logger.debug("CHAT %s: HANDLING INCOMING MESSAGE FROM USER %s...", self.chat_id, from_id)
+
+        # Messages are published to the other instances, so they must fit into a notification
+        if self.cluster is not None and not self.cluster.fits_message(self.chat_id, from_id, text):
+            logger.warning("CHAT %s: MESSAGE OF USER %s IS TOO LONG, REJECTED", self.chat_id, from_id)
+            self.notify_sender(from_id, self.MESSAGE_TOO_LONG)
+            return
+
+        # Message ids are assigned by the home instance of the chat only
+        if not self.is_home:
+            self.cluster.submit(self.chat_id, from_id, text)
+            logger.debug("CHAT %s: MESSAGE SUBMITTED TO HOME INSTANCE", self.chat_id)
+            return
 
         self.last_message_id += 1
         new_message = self.Message(message_id=self.last_message_id,
                                    from_id=from_id,
                                    text=text)
-        self.messages.append(new_message)
+        self.messages.append(self.last_message_id, from_id, text)
 
-        for other_user_id, other_ws in self.clients.items():
+        started = time.perf_counter()
+        for other_user_id, other_outbox in self.clients.items():
             if other_user_id != from_id:
-                await other_ws.send_str(new_message.text)
-                logger.info("CHAT %s: \tBROADCAST MESSAGE TO USER %s", self.chat_id, other_user_id)
+                other_outbox.send_message(new_message.message_id, new_message.text)
+                logger.debug("CHAT %s: \tQUEUED MESSAGE FOR USER %s", self.chat_id, other_user_id)
+        fanout_latency.observe(time.perf_counter() - started)
+
+        if self.buffer is not None:
+            self.buffer.push(new_message)
 
-        if self.saved_by:
-            new_message.save(self.saving_session, self.chat_id)
-            await self.saving_session.commit()
+        if self.cluster is not None:
+            self.cluster.publish_message(self.chat_id, new_message.message_id, from_id, text)
 
-        logger.info("CHAT %s: MESSAGE HANDLED\n...", self.chat_id)
+        logger.info("CHAT %s: MESSAGE %d HANDLED", self.chat_id, new_message.message_id)
+
+    def receive_remote(self, message_id, from_id, text):
+        """ Delivers message handled by the home instance to the clients connected to this one """
+        if message_id <= self.last_message_id:
+            return
+        self.last_message_id = message_id
+        self.messages.append(message_id, from_id, text)
+        for other_user_id, other_outbox in self.clients.items():
+            if other_user_id != from_id:
+                other_outbox.send_message(message_id, text)
 
     async def try_load_saved_instance(self, session, by_id):
         query = select(db.SavedChat).filter_by(chat_id=self.chat_id,
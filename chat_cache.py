@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from os import getenv
+
+logger = logging.getLogger(__name__)
+
+
+class ChatCache:
+    """ Loaded chats in LRU order, unloads idle ones and trims persisted messages to fit the budget """
+    MAX_CHATS = int(getenv("CHAT_CACHE_MAX_CHATS", 10000))
+    MAX_MESSAGES = int(getenv("CHAT_CACHE_MAX_MESSAGES", 1000000))
+    # Encoded copies of the history kept for the connected users
+    MAX_VIEW_BYTES = int(getenv("CHAT_CACHE_MAX_VIEW_BYTES", 256 * 1024 * 1024))
+    KEPT_MESSAGES = int(getenv("CHAT_CACHE_KEPT_MESSAGES", 100))
+    IDLE_TTL = float(getenv("CHAT_CACHE_IDLE_TTL", 300))
+    SWEEP_INTERVAL = float(getenv("CHAT_CACHE_SWEEP_INTERVAL", 30))
+
+    def __init__(self):
+        self.chats = OrderedDict()
+        self.used_at = {}
+        self.evictions = 0
+        self.idle_unloads = 0
+        self.trimmed_messages = 0
+        self.dropped_views = 0
+        self.sweep_task = None
+
+    def __contains__(self, chat_id):
+        return chat_id in self.chats
+
+    def __len__(self):
+        return len(self.chats)
+
+    def __setitem__(self, chat_id, chat):
+        self.chats[chat_id] = chat
+        self.chats.move_to_end(chat_id)
+        self.used_at[chat_id] = time.monotonic()
+        if len(self.chats) > self.MAX_CHATS:
+            self.schedule_sweep()
+
+    def get(self, chat_id):
+        """ Returns chat and marks it as recently used """
+        chat = self.chats.get(chat_id)
+        if chat is not None:
+            self.chats.move_to_end(chat_id)
+            self.used_at[chat_id] = time.monotonic()
+        return chat
+
+    def pop(self, chat_id, default=None):
+        self.used_at.pop(chat_id, None)
+        return self.chats.pop(chat_id, default)
+
+    def values(self):
+        return self.chats.values()
+
+    def resident_messages(self):
+        return sum(len(chat.messages) for chat in self.chats.values())
+
+    def resident_view_bytes(self):
+        return sum(chat.messages.view_bytes() for chat in self.chats.values())
+
+    def schedule_sweep(self):
+        if self.sweep_task is None or self.sweep_task.done():
+            self.sweep_task = asyncio.create_task(self.sweep())
+
+    async def sweep(self):
+        """ Unloads idle chats nobody has joined, then trims, drops views and evicts least recently used chats over budget """
+        now = time.monotonic()
+        for chat_id, chat in list(self.chats.items()):
+            if not chat.clients and now - self.used_at[chat_id] > self.IDLE_TTL:
+                if await self.unload(chat_id):
+                    self.idle_unloads += 1
+
+        resident_messages = self.resident_messages()
+        if resident_messages > self.MAX_MESSAGES:
+            for chat in list(self.chats.values()):
+                trimmed = chat.trim(self.KEPT_MESSAGES)
+                self.trimmed_messages += trimmed
+                resident_messages -= trimmed
+                if resident_messages <= self.MAX_MESSAGES:
+                    break
+
+        # Views are rebuilt from the messages on the next history request, so they go before the chats
+        resident_view_bytes = self.resident_view_bytes()
+        if resident_view_bytes > self.MAX_VIEW_BYTES:
+            for chat in list(self.chats.values()):
+                resident_view_bytes -= chat.messages.view_bytes()
+                self.dropped_views += len(chat.messages.views)
+                chat.messages.views.clear()
+                if resident_view_bytes <= self.MAX_VIEW_BYTES:
+                    break
+
+        for chat_id, chat in list(self.chats.items()):
+            if (len(self.chats) <= self.MAX_CHATS and resident_messages <= self.MAX_MESSAGES
+                    and resident_view_bytes <= self.MAX_VIEW_BYTES):
+                break
+            if not chat.clients:
+                resident_messages -= len(chat.messages)
+                resident_view_bytes -= chat.messages.view_bytes()
+                if await self.unload(chat_id):
+                    self.evictions += 1
+
+        logger.info("CHAT CACHE: %d CHATS, %d MESSAGES, %d VIEW BYTES RESIDENT",
+                    len(self.chats), resident_messages, resident_view_bytes)
+
+    async def unload(self, chat_id):
+        """ Flushes the chat first and drops it only if nobody has joined meanwhile, returns whether it was dropped """
+        # While the chat is cached, a rejoining user gets it instead of a reload missing the unsaved messages
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return False
+        await chat.flush()
+        if chat.clients or not chat.is_flushed() or self.chats.get(chat_id) is not chat:
+            return False
+        self.pop(chat_id)
+        await chat.unload()
+        logger.info("CHAT %s: UNLOADED FROM CACHE", chat_id)
+        return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("CHAT CACHE SWEEP FAILED")
+
+    def get_stats(self):
+        return {
+            "chats": len(self.chats),
+            "messages": self.resident_messages(),
+            "view_bytes": self.resident_view_bytes(),
+            "evictions": self.evictions,
+            "idle_unloads": self.idle_unloads,
+            "trimmed_messages": self.trimmed_messages,
+            "dropped_views": self.dropped_views,
+        }
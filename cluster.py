@@ -0,0 +1,574 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from os import getenv
+
+import asyncpg
+
+from sqlalchemy import func, select
+
+import db
+from chat import Chat
+from matchmaking import remember_finished
+
+logger = logging.getLogger(__name__)
+
+
+class PostgresBus:
+    """ Notifications and advisory locks over a dedicated asyncpg connection, shared by all app instances """
+    CHANNEL = "swapchad"
+    APPLICATION_NAME = "swapchad-bus"
+    MAX_PAYLOAD = 7900
+    HAS_MATCHMAKER = False
+    RECONNECT_DELAY = 1
+    # Query of a connection, which died silently, is not answered, such a connection is replaced
+    QUERY_TIMEOUT = float(getenv("CLUSTER_QUERY_TIMEOUT", 10))
+
+    def __init__(self, dsn):
+        self.dsn = dsn.replace("postgresql+asyncpg://", "postgresql://", 1)
+        self.connection = None
+        self.operations = asyncio.Queue()
+        self.task = None
+        self.on_message = None
+        self.on_reset = None
+
+    async def connect(self, on_message, on_reset=None):
+        self.on_message = on_message
+        self.on_reset = on_reset
+        await self.open()
+        self.task = asyncio.create_task(self.run())
+
+    async def open(self):
+        self.connection = await asyncpg.connect(self.dsn, server_settings={"application_name": self.APPLICATION_NAME})
+        self.connection.add_termination_listener(self.on_terminated)
+        await self.connection.add_listener(self.CHANNEL,
+                                           lambda _connection, _pid, _channel, payload: self.on_message(payload))
+
+    def on_terminated(self, connection):
+        # Wakes up the run loop, unless the connection was closed on purpose
+        if connection is self.connection:
+            self.operations.put_nowait(None)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        # Operations, which were not executed, are failed, so nobody waits for their results forever
+        while not self.operations.empty():
+            operation = self.operations.get_nowait()
+            self.operations.task_done()
+            if operation is not None and operation[2] is not None and not operation[2].done():
+                operation[2].set_exception(ConnectionError("Cluster bus was closed"))
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            await connection.close()
+
+    async def run(self):
+        # Locks and LISTEN belong to the session, so the owner of the bus restores them on reset
+        while True:
+            await self.execute_operations()
+            logger.error("CLUSTER: BUS CONNECTION WAS LOST, RECONNECTING")
+            await self.reconnect()
+            logger.info("CLUSTER: BUS CONNECTION WAS RESTORED")
+            if self.on_reset is not None:
+                self.on_reset()
+
+    # Dedicated connection can't run queries concurrently, so all of them are executed one by one
+    async def execute_operations(self):
+        """ Runs queued queries until the connection is lost """
+        while True:
+            operation = await self.operations.get()
+            try:
+                if operation is None:
+                    if self.connection is None or self.connection.is_closed():
+                        return
+                    continue
+                query, args, future = operation
+                try:
+                    result = await self.connection.fetchval(query, *args, timeout=self.QUERY_TIMEOUT)
+                except Exception as exc:
+                    logger.exception("CLUSTER: QUERY FAILED")
+                    if future is not None and not future.done():
+                        future.set_exception(exc)
+                    if isinstance(exc, asyncio.TimeoutError) or self.connection.is_closed():
+                        return
+                else:
+                    if future is not None and not future.done():
+                        future.set_result(result)
+            finally:
+                self.operations.task_done()
+
+    async def reconnect(self):
+        connection, self.connection = self.connection, None
+        connection.terminate()
+        while True:
+            await asyncio.sleep(self.RECONNECT_DELAY)
+            try:
+                await self.open()
+                return
+            except Exception as exc:
+                logger.warning("CLUSTER: BUS RECONNECTION FAILED: %s", exc)
+                if self.connection is not None:
+                    connection, self.connection = self.connection, None
+                    connection.terminate()
+
+    def execute(self, query, *args, wait=False):
+        future = (asyncio.get_running_loop().create_future() if wait else None)
+        self.operations.put_nowait((query, args, future))
+        return future
+
+    async def drain(self):
+        await self.operations.join()
+
+    def notify(self, payload):
+        self.execute("SELECT pg_notify($1, $2)", self.CHANNEL, payload)
+
+    def try_lock(self, key, wait=True):
+        return self.execute("SELECT pg_try_advisory_lock($1)", key, wait=wait)
+
+    def unlock(self, key):
+        self.execute("SELECT pg_advisory_unlock($1)", key)
+
+    def holds_lock(self, key):
+        """ Checks that the session still holds the lock, bigint keys are split into classid and objid """
+        return self.execute("SELECT EXISTS (SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND granted"
+                            " AND pid = pg_backend_pid() AND objsubid = 1"
+                            " AND (classid::bigint << 32 | objid::bigint) = $1)", key, wait=True)
+
+
+class Cluster:
+    """ Connects app instances through a bus of notifications and locks (Postgres LISTEN/NOTIFY or hub process)
+
+    Every chat has a home instance, which holds lock of the chat. Home assigns message ids and persists
+    messages, other instances keep replicas of the chat, forward their users' messages to the home and
+    deliver messages published by the home to their local clients. Matchmaking is done by the instance
+    holding the matchmaker lock or by the hub, others forward searches to it.
+    """
+    ENABLED = getenv("CLUSTER_MODE", "0") == "1"
+    MATCHMAKER_LOCK = int.from_bytes(b"SwapChad", "big")
+    ELECTION_INTERVAL = float(getenv("CLUSTER_ELECTION_INTERVAL", 5))
+    SYNC_TIMEOUT = float(getenv("CLUSTER_SYNC_TIMEOUT", 3))
+    # Home, which doesn't publish a submitted message in time, is considered lost and the chat is claimed
+    SUBMIT_TIMEOUT = float(getenv("CLUSTER_SUBMIT_TIMEOUT", 3))
+    STOP_TIMEOUT = float(getenv("CLUSTER_STOP_TIMEOUT", 5))
+    # Search is repeated until the matchmaker confirms it, and fails if the matchmaker stays silent
+    SEARCH_CHECK_INTERVAL = float(getenv("CLUSTER_SEARCH_CHECK_INTERVAL", 5))
+    SEARCH_CHECK_ATTEMPTS = int(getenv("CLUSTER_SEARCH_CHECK_ATTEMPTS", 3))
+
+    def __init__(self, lobby, bus):
+        self.lobby = lobby
+        self.bus = bus
+        self.instance_id = uuid.uuid4().hex
+        self.tasks = []
+        self.is_matchmaker = False
+        self.searches = {}
+        self.accepted_searches = set()
+        self.proxied_searches = {}
+        self.finished_searches = {}
+        self.syncs = {}
+        self.pending_submits = {}
+        self.takeovers = set()
+
+    async def start(self):
+        await self.bus.connect(self.on_notification, on_reset=self.on_bus_reset)
+        if not self.bus.HAS_MATCHMAKER:
+            self.tasks.append(asyncio.create_task(self.run_election()))
+        logger.info("CLUSTER: INSTANCE %s JOINED", self.instance_id)
+
+    async def stop(self):
+        """ Hands chats over to the replicas on other instances before leaving the cluster """
+        for chat in list(self.lobby.chats.values()):
+            if chat.is_home:
+                self.release(chat.chat_id)
+        try:
+            await asyncio.wait_for(self.bus.drain(), self.STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("CLUSTER: PENDING NOTIFICATIONS WERE NOT SENT IN TIME")
+        for task in self.tasks:
+            task.cancel()
+        await self.bus.close()
+
+    def on_bus_reset(self):
+        """ Bus has lost its state (reconnected), locks of home chats are taken again, searches are failed """
+        self.resign()
+        for chat in self.lobby.chats.values():
+            if chat.is_home:
+                self.claim_new(chat.chat_id)
+        for _request_id, future in self.searches.values():
+            if not future.done():
+                future.set_exception(self.lobby.SearchTimeoutError())
+
+    def encode(self, kind, **payload):
+        return json.dumps({"kind": kind, "origin": self.instance_id, **payload})
+
+    def publish(self, kind, **payload):
+        payload = self.encode(kind, **payload)
+        if len(payload.encode("utf-8")) > self.bus.MAX_PAYLOAD:
+            logger.error("CLUSTER: %s NOTIFICATION IS TOO LARGE (%d BYTES), DROPPED", kind.upper(), len(payload))
+            return
+        self.bus.notify(payload)
+
+    def fits_message(self, chat_id, from_id, text):
+        """ Checks that the message fits into the notification publishing it, largest possible id is assumed """
+        payload = self.encode("message", chat_id=chat_id.hex, message_id=2 ** 31, from_id=from_id.hex, text=text)
+        return len(payload.encode("utf-8")) <= self.bus.MAX_PAYLOAD
+
+    @staticmethod
+    def lock_key(chat_id):
+        return int.from_bytes(chat_id.bytes[:8], "big", signed=True)
+
+    async def claim(self, chat_id):
+        """ Tries to become home of the chat """
+        return await self.bus.try_lock(self.lock_key(chat_id))
+
+    def claim_new(self, chat_id):
+        """ Makes this instance home of the chat just created here, lock is queued before any notification about it """
+        self.bus.try_lock(self.lock_key(chat_id), wait=False)
+
+    def release(self, chat_id):
+        self.bus.unlock(self.lock_key(chat_id))
+        self.publish("released", chat_id=chat_id.hex)
+
+    async def run_election(self):
+        """ Keeps a single matchmaker, lock of the matchmaker is checked as it is lost along with the session """
+        while True:
+            try:
+                if self.is_matchmaker and not await self.bus.holds_lock(self.MATCHMAKER_LOCK):
+                    self.resign()
+                if not self.is_matchmaker:
+                    self.is_matchmaker = await self.bus.try_lock(self.MATCHMAKER_LOCK)
+                    if self.is_matchmaker:
+                        logger.info("CLUSTER: INSTANCE %s IS THE MATCHMAKER NOW", self.instance_id)
+            except Exception:
+                logger.exception("CLUSTER: MATCHMAKER ELECTION FAILED")
+            await asyncio.sleep(self.ELECTION_INTERVAL)
+
+    def resign(self):
+        """ Gives up matchmaking, other instances repeat their searches to the new matchmaker """
+        if not self.is_matchmaker:
+            return
+        logger.error("CLUSTER: INSTANCE %s HAS LOST THE MATCHMAKER LOCK", self.instance_id)
+        self.is_matchmaker = False
+        for _request_id, task in self.proxied_searches.values():
+            task.cancel()
+        self.lobby.matchmaker.fail_all()
+
+    # Chats
+
+    def attach(self, chat, is_home):
+        chat.cluster = self
+        chat.is_home = is_home
+
+    def publish_message(self, chat_id, message_id, from_id, text):
+        self.publish("message", chat_id=chat_id.hex, message_id=message_id, from_id=from_id.hex, text=text)
+
+    def submit(self, chat_id, from_id, text):
+        """ Forwards message to the home, which is expected to publish it back within SUBMIT_TIMEOUT """
+        self.pending_submits.setdefault(chat_id, []).append((from_id, text, time.monotonic() + self.SUBMIT_TIMEOUT))
+        self.publish("submit", chat_id=chat_id.hex, from_id=from_id.hex, text=text)
+        asyncio.get_running_loop().call_later(self.SUBMIT_TIMEOUT, self.check_submits, chat_id)
+
+    def confirm_submit(self, chat_id, from_id, text):
+        pending = self.pending_submits.get(chat_id)
+        if not pending:
+            return
+        for index, (pending_from_id, pending_text, _deadline) in enumerate(pending):
+            if pending_from_id == from_id and pending_text == text:
+                del pending[index]
+                break
+        if not pending:
+            del self.pending_submits[chat_id]
+
+    def check_submits(self, chat_id):
+        pending = self.pending_submits.get(chat_id)
+        if not pending or pending[0][2] > time.monotonic():
+            return
+        chat = self.lobby.chats.get(chat_id)
+        if chat is None or chat.is_home:
+            self.pending_submits.pop(chat_id, None)
+            return
+        logger.error("CLUSTER: HOME OF CHAT %s DID NOT PUBLISH SUBMITTED MESSAGES, CLAIMING THE CHAT", chat_id)
+        asyncio.create_task(self.take_over(chat, lost=True))
+
+    def publish_left(self, chat_id, user_id):
+        self.publish("left", chat_id=chat_id.hex, user_id=user_id.hex)
+
+    def publish_saved(self, chat_id, persisted_id):
+        self.publish("saved", chat_id=chat_id.hex, persisted_id=persisted_id)
+
+    def publish_invalidate(self, user_id, usernames, deleted):
+        self.publish("invalidate", user_id=user_id.hex, usernames=list(usernames), deleted=deleted)
+
+    def publish_invalidate_all(self):
+        self.publish("invalidate_all")
+
+    async def get_chat(self, chat_id):
+        """ Loads chat, which is not in memory, either as its new home or as replica of another instance's one """
+        if await self.claim(chat_id):
+            chat = await Chat.try_load_saved(self.lobby.session_factory, chat_id)
+            if chat is None:
+                self.bus.unlock(self.lock_key(chat_id))
+                return None
+            self.attach(chat, is_home=True)
+            return chat
+        return await self.sync(chat_id)
+
+    async def sync(self, chat_id):
+        """ Builds replica of the chat from the history sent by its home """
+        request_id = uuid.uuid4().hex
+        sync = self.syncs[request_id] = {
+            "chat_id": chat_id,
+            "rows": [],
+            "pending": [],
+            "saved": None,
+            "last_message_id": 0,
+            "done": asyncio.get_running_loop().create_future(),
+        }
+        self.publish("sync", chat_id=chat_id.hex, request_id=request_id)
+        try:
+            await asyncio.wait_for(sync["done"], self.SYNC_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("CLUSTER: CHAT %s WAS NOT SYNCED IN TIME", chat_id)
+            return None
+        finally:
+            del self.syncs[request_id]
+
+        chat = Chat(chat_id, self.lobby.session_factory)
+        for message_id, from_id, text in sync["rows"]:
+            chat.messages.append(message_id, from_id, text)
+        chat.last_message_id = sync["last_message_id"]
+        chat.first_loaded_id = (sync["rows"][0][0] if sync["rows"] else chat.last_message_id + 1)
+        self.attach(chat, is_home=False)
+        if sync["saved"] is not None:
+            chat.mark_saved(sync["saved"])
+        for message_id, from_id, text in sync["pending"]:
+            chat.receive_remote(message_id, from_id, text)
+        return chat
+
+    def send_history(self, chat, request_id):
+        """ Sends chat's messages to the syncing instance in chunks fitting into notification payload """
+        chunk, size = [], 0
+        for message_id, from_id, text in chat.messages:
+            row = [message_id, from_id.hex, text]
+            row_size = len(json.dumps(row).encode("utf-8"))
+            if chunk and size + row_size > self.bus.MAX_PAYLOAD - 300:
+                self.publish("history", chat_id=chat.chat_id.hex, request_id=request_id, rows=chunk)
+                chunk, size = [], 0
+            chunk.append(row)
+            size += row_size
+        self.publish("history", chat_id=chat.chat_id.hex, request_id=request_id, rows=chunk, done=True,
+                     last_message_id=chat.last_message_id,
+                     saved=(chat.buffer.persisted_id if chat.buffer is not None else None))
+
+    # Matchmaking
+
+    async def search(self, user_id, tags):
+        """ Forwards search to the matchmaker instance and waits for its result """
+        if user_id in self.searches:
+            raise self.lobby.AlreadySearchingError()
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self.searches[user_id] = (request_id, future)
+        try:
+            missed = 0
+            while missed < self.SEARCH_CHECK_ATTEMPTS:
+                # Repeated search is only confirmed by the matchmaker, which runs it already
+                self.publish("search", request_id=request_id, user_id=user_id.hex, tags=list(tags))
+                done, _ = await asyncio.wait({future}, timeout=self.SEARCH_CHECK_INTERVAL)
+                if done:
+                    return future.result()
+                if request_id in self.accepted_searches:
+                    self.accepted_searches.discard(request_id)
+                    missed = 0
+                else:
+                    missed += 1
+            logger.error("CLUSTER: SEARCH OF USER %s WAS NOT CONFIRMED BY THE MATCHMAKER", user_id)
+            self.publish("abort", user_id=user_id.hex)
+            raise self.lobby.SearchTimeoutError()
+        except asyncio.CancelledError:
+            self.publish("abort", user_id=user_id.hex)
+            raise
+        finally:
+            self.searches.pop(user_id, None)
+            self.accepted_searches.discard(request_id)
+
+    def abort_search(self, user_id):
+        """ Abort is published even if the search runs on another instance, the local one only chooses the response """
+        self.publish("abort", user_id=user_id.hex)
+        if user_id not in self.searches:
+            raise self.lobby.WasNotSearchingError()
+
+    async def proxy_search(self, request_id, user_id, tags):
+        """ Runs search of another instance's user on the local matchmaker """
+        try:
+            chat_id = await self.lobby.matchmaker.start_search_and_wait(user_id, tags)
+            self.publish("matched", request_id=request_id, chat_id=(chat_id.hex if chat_id else None))
+        except self.lobby.AlreadySearchingError:
+            self.publish("matched", request_id=request_id, error="already_searching")
+        except self.lobby.SearchTimeoutError:
+            self.publish("matched", request_id=request_id, error="timeout")
+        except asyncio.CancelledError:
+            # Matchmaker has resigned, the repeated search may be accepted here again later
+            if self.proxied_searches.get(user_id, (None,))[0] == request_id:
+                del self.proxied_searches[user_id]
+            raise
+        if self.proxied_searches.get(user_id, (None,))[0] == request_id:
+            del self.proxied_searches[user_id]
+        remember_finished(self.finished_searches, request_id)
+
+    # Notifications
+
+    def on_notification(self, payload):
+        try:
+            notification = json.loads(payload)
+            if notification["origin"] == self.instance_id:
+                return
+            getattr(self, "on_" + notification["kind"])(notification)
+        except Exception:
+            logger.exception("CLUSTER: FAILED TO HANDLE NOTIFICATION")
+
+    def get_local_chat(self, notification):
+        return self.lobby.chats.get(uuid.UUID(notification["chat_id"]))
+
+    def on_message(self, notification):
+        row = (notification["message_id"], uuid.UUID(notification["from_id"]), notification["text"])
+        for sync in self.syncs.values():
+            if sync["chat_id"].hex == notification["chat_id"]:
+                sync["pending"].append(row)
+        self.confirm_submit(uuid.UUID(notification["chat_id"]), row[1], row[2])
+        chat = self.get_local_chat(notification)
+        if chat is not None and not chat.is_home:
+            chat.receive_remote(*row)
+
+    def on_submit(self, notification):
+        chat = self.get_local_chat(notification)
+        if chat is not None and chat.is_home:
+            asyncio.create_task(chat.handle_update(uuid.UUID(notification["from_id"]), notification["text"]))
+
+    def on_left(self, notification):
+        chat = self.get_local_chat(notification)
+        if chat is not None:
+            chat.notify_left(uuid.UUID(notification["user_id"]))
+
+    def on_saved(self, notification):
+        chat = self.get_local_chat(notification)
+        if chat is not None:
+            chat.mark_saved(notification["persisted_id"])
+
+    def on_invalidate(self, notification):
+        self.lobby.forget_user(uuid.UUID(notification["user_id"]), notification["usernames"], notification["deleted"])
+
+    def on_invalidate_all(self, _notification):
+        self.lobby.forget_all_users()
+
+    def on_released(self, notification):
+        chat = self.get_local_chat(notification)
+        if chat is not None and not chat.is_home:
+            asyncio.create_task(self.take_over(chat))
+
+    async def take_over(self, chat, lost=False):
+        """ Makes this instance home of the replicated chat, whose home has either released it or is lost """
+        if chat.chat_id in self.takeovers:
+            return
+        self.takeovers.add(chat.chat_id)
+        try:
+            if not await self.claim(chat.chat_id):
+                if lost:
+                    # Home is still alive, but the overdue messages are not coming anymore
+                    now = time.monotonic()
+                    pending = self.pending_submits.get(chat.chat_id, [])
+                    while pending and pending[0][2] <= now:
+                        chat.notify_sender(pending.pop(0)[0], chat.NOT_DELIVERED)
+                    if not pending:
+                        self.pending_submits.pop(chat.chat_id, None)
+                return
+            chat.is_home = True
+            last_message_id = chat.last_message_id
+            if chat.buffer is not None:
+                if lost:
+                    await self.persist_lost_messages(chat, last_message_id)
+                else:
+                    chat.buffer.persisted_id = last_message_id
+            logger.info("CLUSTER: CHAT %s MOVED TO INSTANCE %s", chat.chat_id, self.instance_id)
+
+            # Messages submitted to the previous home are handled here now
+            for from_id, text, _deadline in self.pending_submits.pop(chat.chat_id, []):
+                await chat.handle_update(from_id, text)
+        finally:
+            self.takeovers.discard(chat.chat_id)
+
+    async def persist_lost_messages(self, chat, last_message_id):
+        """ Lost home might not have written its latest messages, ones kept by the replica are written again """
+        query = select(func.max(db.Message.message_id)).filter_by(chat_id=chat.chat_id)
+        async with self.lobby.session_factory() as session:
+            persisted_id = (await session.execute(query)).scalar() or 0
+        chat.buffer.persisted_id = persisted_id
+        for message_id, from_id, text in chat.messages.rows(chat.messages.index_after(persisted_id)):
+            if message_id > last_message_id:
+                break
+            chat.buffer.push(Chat.Message(message_id, from_id, text))
+
+    def on_sync(self, notification):
+        chat = self.get_local_chat(notification)
+        if chat is not None and chat.is_home:
+            self.send_history(chat, notification["request_id"])
+
+    def on_history(self, notification):
+        sync = self.syncs.get(notification["request_id"])
+        if sync is None:
+            return
+        sync["rows"].extend((message_id, uuid.UUID(from_id), text)
+                            for message_id, from_id, text in notification["rows"])
+        if notification.get("done"):
+            sync["saved"] = notification["saved"]
+            sync["last_message_id"] = notification["last_message_id"]
+            sync["done"].set_result(True)
+
+    def on_search(self, notification):
+        if not self.is_matchmaker:
+            return
+        user_id = uuid.UUID(notification["user_id"])
+        request_id = notification["request_id"]
+        if request_id in self.finished_searches:
+            return
+        running = self.proxied_searches.get(user_id)
+        if running is not None and running[0] != request_id:
+            # Search of the same user from another instance must not replace the running one
+            self.publish("matched", request_id=request_id, error="already_searching")
+            return
+        if running is None:
+            self.proxied_searches[user_id] = (request_id, asyncio.create_task(
+                self.proxy_search(request_id, user_id, notification["tags"])))
+        self.publish("accepted", request_id=request_id)
+
+    def on_accepted(self, notification):
+        if any(request_id == notification["request_id"] for request_id, _future in self.searches.values()):
+            self.accepted_searches.add(notification["request_id"])
+
+    def on_abort(self, notification):
+        if not self.is_matchmaker:
+            return
+        try:
+            self.lobby.matchmaker.abort_search(uuid.UUID(notification["user_id"]))
+        except self.lobby.WasNotSearchingError:
+            pass
+
+    def on_matched(self, notification):
+        chat_id = (uuid.UUID(notification["chat_id"]) if notification.get("chat_id") else None)
+        if chat_id is not None and notification.get("home"):
+            # Hub has already given the lock of the new chat to this instance, the partner joins it even if
+            # the search here was cancelled meanwhile
+            self.lobby.create_chat(chat_id, claim=False)
+
+        for user_id, (request_id, future) in self.searches.items():
+            if request_id != notification["request_id"] or future.done():
+                continue
+            error = notification.get("error")
+            if error == "already_searching":
+                future.set_exception(self.lobby.AlreadySearchingError())
+            elif error == "timeout":
+                future.set_exception(self.lobby.SearchTimeoutError())
+            else:
+                future.set_result(chat_id)
+            return
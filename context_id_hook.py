@@ -1,11 +1,17 @@
 from aiohttp import web, web_log
 from contextvars import ContextVar
-from contextlib import ExitStack
 import logging
+import re
+import uuid
+
+import tracing
 
 
 _hook_var = ContextVar('request_id')
-_hook_last_request_id = 0
+_hook_upstream_var = ContextVar('upstream_request_id', default=None)
+_hook_request_id_re = re.compile(r'[\w\-]{1,64}')
+_mapped_logger = logging.getLogger("MAPPED")
+_unmapped_logger = logging.getLogger("UNMAPPED")
 
 
 def setup():
@@ -18,6 +24,8 @@ def setup():
     def _context_id_hook_factory(*args, **kwargs):
         record = factory(*args, **kwargs)
         req_id = _hook_var.get(None)
+        record.request_id = req_id
+        record.upstream_request_id = _hook_upstream_var.get()
         record.requestIdPrefix = f'[{req_id}]' if req_id else '?'
         return record
 
@@ -27,26 +35,38 @@ def setup():
 class AccessLogClass(web_log.AccessLogger):
     def log(self, request, response, time):
         token = _hook_var.set(request.get("request_id"))
+        upstream_token = _hook_upstream_var.set(_upstream_request_id(request))
         try:
             super().log(request, response, time)
         finally:
+            _hook_upstream_var.reset(upstream_token)
             _hook_var.reset(token)
 
 
+def _upstream_request_id(request):
+    """ Id assigned by the router (Heroku sets X-Request-ID), it is logged separately as clients may set it too """
+    request_id = request.headers.get('X-Request-ID', '')
+    return request_id if _hook_request_id_re.fullmatch(request_id) else None
+
+
 @web.middleware
 async def middleware(request, handler):
-    global _hook_last_request_id
-    _hook_last_request_id += 1
-    new_request_id = _hook_last_request_id
+    new_request_id = uuid.uuid4().hex
     request['request_id'] = new_request_id
     token = _hook_var.set(new_request_id)
+    upstream_token = _hook_upstream_var.set(_upstream_request_id(request))
+    trace = tracing.start(request)
+    trace_token = tracing.current.set(trace)
     try:
-        with ExitStack():
-            mapping = handler.__dict__.get('__rororo_openapi_mapping__')
-            if mapping:
-                logging.getLogger("MAPPED").info(str(mapping.get("*")))
-            else:
-                logging.getLogger("UNMAPPED").info(f'{handler.__module__}:{handler.__name__}')
-            return await handler(request)
+        mapping = handler.__dict__.get('__rororo_openapi_mapping__')
+        if mapping:
+            _mapped_logger.debug("%s", mapping.get("*"))
+        else:
+            _unmapped_logger.debug("%s:%s", handler.__module__, handler.__name__)
+        return await handler(request)
     finally:
+        if trace is not None:
+            tracing.finish(trace, request)
+        tracing.current.reset(trace_token)
+        _hook_upstream_var.reset(upstream_token)
         _hook_var.reset(token)
@@ -1,8 +1,21 @@
+import asyncio
+import logging
+import time
+from os import getenv
+
 import sqlalchemy as sa
-from sqlalchemy import orm
+from sqlalchemy import orm, event
 from sqlalchemy.dialects.postgresql.asyncpg import UUID
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 import aiohttp_sqlalchemy as ahsa
 
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
 
 metadata = sa.MetaData()
 Base = orm.declarative_base(metadata=metadata)
@@ -19,6 +32,10 @@ class User(Base):
 
 class SavedChat(Base):
     __tablename__ = "saved_chat"
+    __table_args__ = (
+        # Covers listing of user's saved chats, which is paginated by chat_id
+        sa.Index("ix_saved_chat_user_id", "user_id", "chat_id", postgresql_include=["title", "offset"]),
+    )
     chat_id = sa.Column(UUID(as_uuid=True), primary_key=True)
     user_id = sa.Column(UUID(as_uuid=True), sa.ForeignKey('user.user_id'), primary_key=True)
     offset = sa.Column(sa.Integer, nullable=False, default=0)
@@ -33,17 +50,152 @@ class Message(Base):
     text = sa.Column(sa.String, nullable=False)
 
 
+POOL_SIZE = int(getenv("DB_POOL_SIZE", 5))
+MAX_OVERFLOW = int(getenv("DB_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = float(getenv("DB_POOL_TIMEOUT", 30))
+POOL_RECYCLE = int(getenv("DB_POOL_RECYCLE", -1))
+POOL_PRE_PING = getenv("DB_POOL_PRE_PING", "0") == "1"
+STATEMENT_CACHE_SIZE = int(getenv("DB_STATEMENT_CACHE_SIZE", 100))
+QUERY_CACHE_SIZE = int(getenv("DB_QUERY_CACHE_SIZE", 500))
+SAMPLE_INTERVAL = float(getenv("DB_POOL_SAMPLE_INTERVAL", 60))
+
+
+class PoolStats:
+    """ Connection acquisition and statement cache counters of the engine """
+    def __init__(self):
+        self.acquisitions = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.statement_cache_hits = 0
+        self.statement_cache_misses = 0
+        self.last_sample = {}
+
+    def record_wait(self, seconds):
+        self.acquisitions += 1
+        self.wait_seconds += seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def record_statement(self, context, *_args):
+        if context.cache_hit is CACHE_HIT:
+            self.statement_cache_hits += 1
+        elif context.cache_hit is CACHE_MISS:
+            self.statement_cache_misses += 1
+
+    def sample(self, pool):
+        statements = self.statement_cache_hits + self.statement_cache_misses
+        self.last_sample = {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "acquisitions": self.acquisitions,
+            "avg_wait_seconds": (self.wait_seconds / self.acquisitions if self.acquisitions else 0),
+            "max_wait_seconds": self.max_wait_seconds,
+            "statement_cache_hit_rate": (self.statement_cache_hits / statements if statements else 0),
+        }
+        self.max_wait_seconds = 0.0
+        return self.last_sample
+
+
+stats = PoolStats()
+statement_latency = metrics.registry.histogram("swapchad_db_statement_seconds", "Latency of DB statements")
+
+
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_started_at = time.perf_counter()
+
+
+def finish_statement(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - context.metrics_started_at
+    statement_latency.observe(seconds)
+    tracing.record("db", seconds)
+    stats.record_statement(context)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """ Queue pool, which measures how long it takes to acquire a connection """
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            stats.record_wait(time.perf_counter() - started)
+
+
+def create_engine(url):
+    """ Creates engine with pool and statement caches configured from the environment """
+    engine = create_async_engine(
+        url,
+        poolclass=TimedQueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_recycle=POOL_RECYCLE,
+        pool_pre_ping=POOL_PRE_PING,
+        query_cache_size=QUERY_CACHE_SIZE,
+        connect_args={"prepared_statement_cache_size": STATEMENT_CACHE_SIZE},
+    )
+    # Compiled cache hits also mean asyncpg reuses its prepared statement for the same SQL
+    event.listen(engine.sync_engine, "before_cursor_execute", start_statement)
+    event.listen(engine.sync_engine, "after_cursor_execute", finish_statement)
+    return engine
+
+
+def create_missing_indexes(connection):
+    """ Creates indexes, which were added after their tables had been created """
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+async def sample_pool(engine):
+    """ Periodically logs pool usage, so dynos can be sized against the Postgres connection limit """
+    while True:
+        await asyncio.sleep(SAMPLE_INTERVAL)
+        sample = stats.sample(engine.sync_engine.pool)
+        logger.info("DB POOL: %s", " ".join(f"{key}={value}" for key, value in sample.items()))
+
+
 async def connect(app, url):
     """ Connects to the database """
     if url.startswith("postgres://"):
         url = url.replace("postgres://", "postgresql+asyncpg://", 1)
 
+    engine = create_engine(url)
+    pool = engine.sync_engine.pool
+    metrics.registry.collector("swapchad_db_pool", lambda: {
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "acquisitions": stats.acquisitions,
+        "wait_seconds": stats.wait_seconds,
+        "statement_cache_hits": stats.statement_cache_hits,
+        "statement_cache_misses": stats.statement_cache_misses,
+    })
     ahsa.setup(app, [
-        ahsa.bind(url),
+        ahsa.bind(engine),
     ])
     await ahsa.init_db(app, metadata=metadata)
+    async with engine.begin() as connection:
+        await connection.run_sync(create_missing_indexes)
+
+    async def start_sampler(app):
+        if SAMPLE_INTERVAL > 0:
+            app["db_sampler"] = asyncio.create_task(sample_pool(engine))
+
+    async def stop_sampler(app):
+        if "db_sampler" in app:
+            app["db_sampler"].cancel()
+        await engine.dispose()
+
+    app.on_startup.append(start_sampler)
+    app.on_cleanup.append(stop_sampler)
 
 
 def get_session(request):
     """ Obtains session from aiohttp_sqlalchemy """
     return ahsa.get_session(request)
+
+
+def get_session_factory(app):
+    """ Obtains factory of sessions, which are not bound to any request """
+    return ahsa.get_session_factory(app)
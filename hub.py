@@ -0,0 +1,246 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import uuid
+
+from matchmaking import Matchmaker, remember_finished
+
+logger = logging.getLogger(__name__)
+
+# Payloads are JSON-encoded once more inside the line, so the line limit leaves room for escaping
+LINE_LIMIT = 2 ** 21
+
+
+class UnixBus:
+    """ Notifications and locks relayed by the hub process to the workers of one host """
+    MAX_PAYLOAD = LINE_LIMIT // 8
+    HAS_MATCHMAKER = True
+    RECONNECT_DELAY = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.replies = {}
+        self.request_ids = itertools.count()
+        self.task = None
+        self.on_message = None
+        self.on_reset = None
+
+    async def connect(self, on_message, on_reset=None):
+        self.on_message = on_message
+        self.on_reset = on_reset
+        await self.open()
+        self.task = asyncio.create_task(self.run())
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.fail_replies()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def run(self):
+        # Restarted hub knows nothing about the previous one, so the owner of the bus restores its locks on reset
+        while True:
+            await self.read()
+            logger.error("HUB CONNECTION WAS CLOSED, RECONNECTING")
+            self.writer.close()
+            self.writer = None
+            self.fail_replies()
+            await self.reconnect()
+            logger.info("HUB CONNECTION WAS RESTORED")
+            if self.on_reset is not None:
+                self.on_reset()
+
+    async def read(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    return
+                message = json.loads(line)
+                if message["op"] == "notify":
+                    self.on_message(message["payload"])
+                else:
+                    future = self.replies.pop(message["id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(message["result"])
+        except ConnectionError:
+            return
+
+    async def reconnect(self):
+        while True:
+            await asyncio.sleep(self.RECONNECT_DELAY)
+            try:
+                await self.open()
+                return
+            except OSError:
+                pass
+
+    def fail_replies(self):
+        for future in self.replies.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Hub connection was closed"))
+        self.replies.clear()
+
+    def send(self, message):
+        # Messages sent while the hub is unavailable are lost
+        if self.writer is not None:
+            self.writer.write(json.dumps(message).encode("utf-8") + b"\n")
+
+    async def drain(self):
+        if self.writer is not None:
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                pass
+
+    def notify(self, payload):
+        self.send({"op": "notify", "payload": payload})
+
+    def try_lock(self, key, wait=True):
+        if not wait:
+            self.send({"op": "lock", "key": key})
+            return None
+        future = asyncio.get_running_loop().create_future()
+        if self.writer is None:
+            future.set_exception(ConnectionError("Hub is not connected"))
+            return future
+        request_id = next(self.request_ids)
+        self.replies[request_id] = future
+        self.send({"op": "lock", "key": key, "id": request_id})
+        return future
+
+    def unlock(self, key):
+        self.send({"op": "unlock", "key": key})
+
+
+class Hub:
+    """ Matchmaker process of the multi-worker mode, relays notifications and keeps chat locks of the workers """
+    ORIGIN = "hub"
+
+    def __init__(self, path):
+        self.path = path
+        self.matchmaker = Matchmaker(self.create_chat)
+        self.writers = set()
+        self.locks = {}
+        self.searches = {}
+        self.finished_searches = {}
+        self.new_chats = set()
+
+    @staticmethod
+    def lock_key(chat_id):
+        return int.from_bytes(chat_id.bytes[:8], "big", signed=True)
+
+    def create_chat(self):
+        chat_id = uuid.uuid4()
+        self.new_chats.add(chat_id)
+        return chat_id
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle_connection, self.path, limit=LINE_LIMIT)
+        logger.info("HUB: LISTENING ON %s", self.path)
+
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stopped.set)
+        async with server:
+            await stopped.wait()
+        os.unlink(self.path)
+
+    async def handle_connection(self, reader, writer):
+        self.writers.add(writer)
+        logger.info("HUB: WORKER CONNECTED (%d TOTAL)", len(self.writers))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.handle(writer, json.loads(line))
+        finally:
+            self.writers.discard(writer)
+            for key, holder in list(self.locks.items()):
+                if holder is writer:
+                    del self.locks[key]
+            for user_id, (task, origin, _request_id) in list(self.searches.items()):
+                if origin is writer:
+                    task.cancel()
+            logger.info("HUB: WORKER DISCONNECTED (%d LEFT)", len(self.writers))
+
+    @staticmethod
+    def send(writer, message):
+        writer.write(json.dumps(message).encode("utf-8") + b"\n")
+
+    def handle(self, writer, message):
+        if message["op"] == "lock":
+            holder = self.locks.setdefault(message["key"], writer)
+            if "id" in message:
+                self.send(writer, {"op": "reply", "id": message["id"], "result": holder is writer})
+        elif message["op"] == "unlock":
+            if self.locks.get(message["key"]) is writer:
+                del self.locks[message["key"]]
+        else:
+            notification = json.loads(message["payload"])
+            if notification["kind"] == "search":
+                # Workers repeat their searches until they are confirmed, the repeated ones are only confirmed
+                user_id = uuid.UUID(notification["user_id"])
+                request_id = notification["request_id"]
+                if request_id in self.finished_searches:
+                    return
+                running = self.searches.get(user_id)
+                if running is not None and running[2] != request_id:
+                    # Search of the same user from another worker must not replace the running one
+                    rejected = {"kind": "matched", "origin": self.ORIGIN, "request_id": request_id,
+                                "error": "already_searching"}
+                    self.send(writer, {"op": "notify", "payload": json.dumps(rejected)})
+                    return
+                if running is None:
+                    task = asyncio.create_task(self.search(writer, request_id, user_id, notification["tags"]))
+                    self.searches[user_id] = (task, writer, request_id)
+                accepted = {"kind": "accepted", "origin": self.ORIGIN, "request_id": request_id}
+                self.send(writer, {"op": "notify", "payload": json.dumps(accepted)})
+            elif notification["kind"] == "abort":
+                try:
+                    self.matchmaker.abort_search(uuid.UUID(notification["user_id"]))
+                except Matchmaker.WasNotSearchingError:
+                    pass
+            else:
+                for other in self.writers:
+                    if other is not writer:
+                        self.send(other, message)
+
+    async def search(self, writer, request_id, user_id, tags):
+        """ Runs worker's search on the matchmaker, the first of the pair to get the result becomes home of the chat """
+        result = {"kind": "matched", "origin": self.ORIGIN, "request_id": request_id}
+        try:
+            chat_id = await self.matchmaker.start_search_and_wait(user_id, tags)
+            result["chat_id"] = (chat_id.hex if chat_id else None)
+            if chat_id in self.new_chats:
+                self.new_chats.discard(chat_id)
+                self.locks[self.lock_key(chat_id)] = writer
+                result["home"] = True
+        except Matchmaker.AlreadySearchingError:
+            result["error"] = "already_searching"
+        except Matchmaker.SearchTimeoutError:
+            result["error"] = "timeout"
+        finally:
+            if self.searches.get(user_id, (None,))[0] is asyncio.current_task():
+                del self.searches[user_id]
+            remember_finished(self.finished_searches, request_id)
+        self.send(writer, {"op": "notify", "payload": json.dumps(result)})
+
+
+def run_hub(path):
+    # Ctrl+C reaches the whole process group, the hub is stopped by the master after the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(Hub(path).serve())
@@ -1,90 +1,142 @@
 import uuid
-from asyncio import Event
+import asyncio
+from asyncio import create_task
 import logging
 
-import db
+from auth import Auth
 from chat import Chat
+from chat_cache import ChatCache
+from cluster import Cluster
+from matchmaking import Matchmaker
+import metrics
+from profile_cache import profiles
 
 logger = logging.getLogger(__name__)
 
 
 class Lobby:
-    def __init__(self):
-        self.chats = {}
-        self.pending = None
-
-    class Pending:
-        def __init__(self, user_id):
-            self.user_id = user_id
-            self.chat_id = None
-            self.event = Event()
-
-        def send(self, chat_id):
-            self.chat_id = chat_id
-            self.event.set()
-
-        async def obtain(self):
-            await self.event.wait()
-            return self.chat_id
-
-    class AlreadySearchingError(Exception):
-        pass
-
-    class WasNotSearchingError(Exception):
-        pass
-
-    async def start_search_and_wait(self, user_id):
-        if self.pending:
-            if self.pending.user_id == user_id:
-                raise self.AlreadySearchingError()
-
-            new_chat_id = uuid.uuid4()
-            self.chats[new_chat_id] = Chat(new_chat_id)
-
-            pending = self.pending
-            self.pending = None
-
-            logger.info("WAS PENDING, CREATED NEW CHAT %s, SENDING AND RETURNING", new_chat_id)
-
-            pending.send(new_chat_id)
-            return new_chat_id
+    def __init__(self, session_factory, bus=None):
+        self.session_factory = session_factory
+        self.chats = ChatCache()
+        self.matchmaker = Matchmaker(self.create_chat)
+        self.cluster = (Cluster(self, bus) if bus is not None else None)
+        self.sweeper = None
+
+    async def start(self):
+        self.register_metrics(metrics.registry)
+        self.sweeper = create_task(self.chats.run())
+        if self.cluster is not None:
+            await self.cluster.start()
+
+    async def stop(self):
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            self.sweeper = None
+        if self.cluster is not None:
+            await self.cluster.stop()
+
+    def register_metrics(self, registry):
+        registry.gauge("swapchad_active_chats", "Chats loaded in memory", lambda: len(self.chats))
+        registry.gauge("swapchad_chat_websockets", "Websockets connected to the chats",
+                       lambda: sum(len(chat.clients) for chat in self.chats.values()))
+        registry.gauge("swapchad_searching_users", "Users waiting for a match", lambda: len(self.matchmaker))
+        registry.register("swapchad_match_wait_seconds", "Time users waited for a match", self.matchmaker.wait_times)
+        registry.collector("swapchad_chat_cache", self.chats.get_stats)
+        registry.collector("swapchad_broadcast", self.get_broadcast_stats)
+
+    def get_broadcast_stats(self):
+        """ Sums send counters of the loaded chats """
+        totals = {"sent": 0, "dropped": 0, "coalesced": 0, "disconnected": 0, "queued_frames": 0}
+        for chat in self.chats.values():
+            stats = chat.broadcast_stats
+            totals["sent"] += stats.sent
+            totals["dropped"] += stats.dropped
+            totals["coalesced"] += stats.coalesced
+            totals["disconnected"] += stats.disconnected
+            totals["queued_frames"] += sum(len(outbox) for outbox in chat.clients.values())
+        return totals
+
+    AlreadySearchingError = Matchmaker.AlreadySearchingError
+    WasNotSearchingError = Matchmaker.WasNotSearchingError
+    SearchTimeoutError = Matchmaker.SearchTimeoutError
+
+    def create_chat(self, chat_id=None, claim=True):
+        new_chat_id = chat_id or uuid.uuid4()
+        chat = Chat(new_chat_id, self.session_factory)
+        if self.cluster is not None:
+            self.cluster.attach(chat, is_home=True)
+            if claim:
+                self.cluster.claim_new(new_chat_id)
+        self.chats[new_chat_id] = chat
+        return new_chat_id
+
+    def is_matchmaker(self):
+        return self.cluster is None or self.cluster.is_matchmaker
+
+    async def start_search_and_wait(self, user_id, tags=()):
+        if not self.is_matchmaker():
+            return await self.cluster.search(user_id, tags)
+        return await self.matchmaker.start_search_and_wait(user_id, tags)
 
+    def abort_search(self, user_id):
+        if not self.is_matchmaker():
+            self.cluster.abort_search(user_id)
+            return
+        self.matchmaker.abort_search(user_id)
+
+    def abort_all_searches(self):
+        self.matchmaker.abort_all()
+
+    def invalidate_user(self, user_id, *usernames, deleted=False):
+        """ Forgets cached profile of the changed user in every instance, tokens are forgotten too if it was deleted """
+        self.forget_user(user_id, usernames, deleted)
+        if self.cluster is not None:
+            self.cluster.publish_invalidate(user_id, usernames, deleted)
+
+    @staticmethod
+    def forget_user(user_id, usernames, deleted):
+        if deleted:
+            Auth.invalidate_user(user_id)
+            profiles.invalidate_deleted(user_id)
         else:
-            pending = self.Pending(user_id)
-            self.pending = pending
-
-            logger.info("NO PENDING, CREATED NEW, WAITING\n...")
-
-            chat_id = await pending.obtain()
+            profiles.invalidate(user_id, *usernames)
 
-            if chat_id is None:
-                logger.info("FINISHED WAITING, CHAT NOT FOUND (ABORTED)")
-            else:
-                logger.info("FINISHED WAITING, GOT CHAT %s", chat_id)
+    def invalidate_all_users(self):
+        """ Forgets cached profiles and tokens of all users in every instance, e.g. once the users were deleted """
+        self.forget_all_users()
+        if self.cluster is not None:
+            self.cluster.publish_invalidate_all()
 
-            return chat_id
-
-    def abort_search(self, user_id):
-        if self.pending is None or self.pending.user_id != user_id:
-            raise self.WasNotSearchingError()
+    @staticmethod
+    def forget_all_users():
+        Auth.verified_tokens.clear()
+        profiles.clear()
 
-        self.pending.send(None)
-        self.pending = None
-
-    async def get_chat(self, request, chat_id):
+    async def get_chat(self, chat_id):
         chat = self.chats.get(chat_id)
         if chat:
             return chat
 
-        chat = await Chat.try_load_saved(db.get_session(request), chat_id)
+        if self.cluster is not None:
+            chat = await self.cluster.get_chat(chat_id)
+        else:
+            chat = await Chat.try_load_saved(self.session_factory, chat_id)
         if chat:
             self.chats[chat_id] = chat
             return chat
 
         return None
 
-    async def proceed_with_chat(self, chat, user_id, ws):
-        await chat.proceed(user_id, ws)
-        if not chat.clients:
-            del self.chats[chat.chat_id]
-            logger.info("CHAT %s: ALL USERS HAVE LEFT, CHAT WAS UNLOADED", chat.chat_id)
+    async def proceed_with_chat(self, chat, user_id, ws, last_message_id=None, limit=None):
+        try:
+            await chat.proceed(user_id, ws, last_message_id=last_message_id, limit=limit)
+        finally:
+            if not chat.clients and self.chats.get(chat.chat_id) is chat and await self.chats.unload(chat.chat_id):
+                logger.info("CHAT %s: ALL USERS HAVE LEFT, CHAT WAS UNLOADED", chat.chat_id)
+
+    async def flush_all(self):
+        for chat in list(self.chats.values()):
+            await chat.flush()
+
+    async def close_all_chats(self, code, message):
+        await asyncio.gather(*(chat.close_clients(code, message) for chat in list(self.chats.values())))
@@ -0,0 +1,145 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from os import getenv
+
+LOG_FORMAT = getenv("LOG_FORMAT", "text")
+# Comma separated logger=value pairs, e.g. "chat=0.01" keeps one of 100 INFO records of the chat logger
+SAMPLE = getenv("LOG_SAMPLE", "")
+RATE_LIMIT = getenv("LOG_RATE_LIMIT", "chat=100,cluster=100")
+
+listener = None
+installed_filters = []
+
+
+class OptionsFilter(logging.Filter):
+    """ Drops access log records of CORS preflight requests """
+    def filter(self, record):
+        line = getattr(record, "first_request_line", None)
+        return line is None or not line.startswith("OPTIONS")
+
+
+class SamplingFilter(logging.Filter):
+    """ Passes every n-th record below WARNING """
+    def __init__(self, rate):
+        super().__init__()
+        self.every = max(1, round(1 / rate))
+        self.seen = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        self.seen += 1
+        return self.seen % self.every == 0
+
+
+class RateLimitFilter(logging.Filter):
+    """ Passes at most the given number of records below WARNING per second, bursts are limited to the same number """
+    def __init__(self, per_second):
+        super().__init__()
+        self.per_second = per_second
+        self.tokens = per_second
+        self.updated_at = time.monotonic()
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.per_second, self.tokens + (now - self.updated_at) * self.per_second)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.dropped += 1
+        return False
+
+
+class DeferredQueueHandler(QueueHandler):
+    """ Enqueues records as they are, so formatting happens on the listener thread instead of the event loop """
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line, carries request ids of the context_id_hook """
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", None),
+            "upstream_request_id": getattr(record, "upstream_request_id", None),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def parse_spec(spec):
+    for item in spec.split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            yield name.strip(), float(value)
+
+
+def install_filters():
+    for logger, log_filter in installed_filters:
+        logger.removeFilter(log_filter)
+    installed_filters.clear()
+    for spec, filter_class in ((SAMPLE, SamplingFilter), (RATE_LIMIT, RateLimitFilter)):
+        for name, value in parse_spec(spec):
+            logger = logging.getLogger(name)
+            log_filter = filter_class(value)
+            logger.addFilter(log_filter)
+            installed_filters.append((logger, log_filter))
+
+
+def setup(text_format, level="INFO"):
+    """ Routes records of the root logger through a queue to stdout, which is written by a background thread """
+    global listener
+    stop()
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(text_format))
+    handler = DeferredQueueHandler(queue.SimpleQueue())
+    handler.addFilter(OptionsFilter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    install_filters()
+
+    listener = QueueListener(handler.queue, output)
+    listener.start()
+
+
+def stop():
+    """ Writes out records, which are still queued """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def restart_in_child():
+    # Listener thread is not inherited by the forked process, its queue is replaced in case it was locked
+    global listener
+    if listener is None:
+        return
+    records = queue.SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, DeferredQueueHandler):
+            handler.queue = records
+    listener = QueueListener(records, *listener.handlers)
+    listener.start()
+
+
+atexit.register(stop)
+os.register_at_fork(after_in_child=restart_in_child)
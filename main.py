@@ -1,21 +1,70 @@
-import sys
+import time
+STARTED_AT = time.perf_counter()  # Before the other imports, so their cost is a part of the startup timing
+
+import argparse
+import inspect
 from pathlib import Path
 from os import getenv
 from typing import Callable, Awaitable
 from aiohttp import web
-import aiohttp_swagger
 import rororo
 import logging
-import logging.config
 
 import db
+import log_pipeline
+import metrics
+import openapi_cache
+import profiler
+import tracing
+from cluster import Cluster, PostgresBus
 from lobby import Lobby
+from auth import Auth
 import api_views
 import context_id_hook
+from swagger_docs import LazySwagger
+
+IMPORTS_SECONDS = time.perf_counter() - STARTED_AT
+
+logger = logging.getLogger(__name__)
+
+
+def create_bus():
+    """ Workers of one host talk through the hub, separate instances through Postgres """
+    if getenv("CLUSTER_HUB"):
+        from hub import UnixBus
+        return UnixBus(getenv("CLUSTER_HUB"))
+    if Cluster.ENABLED:
+        return PostgresBus(getenv("DATABASE_URL"))
+    return None
+
+
+class StartupTimer:
+    """ Durations of the startup steps, logged once the app is ready and exposed as metrics """
+    def __init__(self):
+        self.started_at = self.last = time.perf_counter()
+        self.steps = {"imports": IMPORTS_SECONDS}
+
+    def mark(self, step):
+        now = time.perf_counter()
+        self.steps[step] = now - self.last
+        self.last = now
+
+    def as_dict(self):
+        return {**self.steps, "total": IMPORTS_SECONDS + self.last - self.started_at}
+
+    async def finish(self, _app):
+        self.mark("components")
+        logger.info("STARTUP %s", " ".join(f"{step}={seconds * 1000:.1f}ms" for step, seconds in self.as_dict().items()))
 
 
 async def create_components(app):
-    app["lobby"] = Lobby()
+    app["lobby"] = Lobby(db.get_session_factory(app), bus=create_bus())
+    await app["lobby"].start()
+
+
+async def dispose_components(app):
+    await app["lobby"].stop()
+    Auth.hasher.shutdown()
 
 
 @web.middleware
@@ -32,52 +81,22 @@ async def error_middleware(
 
 def init_logging():
     context_id_hook.setup()
-
-    logging.config.dictConfig({
-        "version": 1,
-        "disable_existing_loggers": False,
-        "handlers": {
-            "stdout": {
-                "class": "logging.StreamHandler",
-                "formatter": ("without_time" if getenv("DYNO") else "default"),
-                "level": "DEBUG",
-                "stream": sys.stdout,
-            },
-        },
-        "formatters": {
-            "default": {
-                "format": "%(asctime)s %(levelname)8s %(requestIdPrefix)-10s %(name)-20s %(message)s"
-            },
-            "without_time": {
-                "format": "%(levelname)8s %(requestIdPrefix)-10s %(name)-20s %(message)s"
-            },
-        },
-        "root": {
-            "level": "INFO",
-            "handlers": ["stdout"],
-        }
-    })
-
-    for handler in logging.getLogger().handlers:
-        _emit = handler.emit
-
-        def emit(record):
-            if (str(record.__dict__.get("first_request_line")) + ".").split()[0] == "OPTIONS":
-                return
-            _emit(record)
-            if record.__dict__.get("name") == 'aiohttp.access':
-                print()
-
-        handler.emit = emit
+    log_pipeline.setup(
+        ("%(levelname)8s %(requestIdPrefix)-10s %(name)-20s %(message)s" if getenv("DYNO") else
+         "%(asctime)s %(levelname)8s %(requestIdPrefix)-10s %(name)-20s %(message)s"),
+    )
 
 
 async def create_app():
+    timer = StartupTimer()
     init_logging()
+    timer.mark("logging")
 
-    app = web.Application(middlewares=[context_id_hook.middleware, error_middleware])
+    app = web.Application(middlewares=[context_id_hook.middleware, metrics.middleware, error_middleware])
 
     # Connect to DB
     await db.connect(app, getenv("DATABASE_URL"))
+    timer.mark("db")
 
     # Initialize rororo lib
     import locale
@@ -88,26 +107,30 @@ async def create_app():
         rororo.BaseSettings(),
     )
 
+    # Validated schema is cached by hash of the file, so unchanged spec is not validated on every boot
+    schema, spec = openapi_cache.load_schema_and_spec(Path(__file__).parent / "openapi.yaml")
     rororo.setup_openapi(
         app,
-        Path(__file__).parent / "openapi.yaml",
         api_views.operations,
-        cors_middleware_kwargs={"allow_all": True},
+        schema=schema,
+        spec=spec,
+        cors_middleware_kwargs={"allow_all": True, "expose_headers": ["X-Next-Cursor"]},
     )
+    # rororo puts its middlewares first, request id and trace must also cover OpenAPI validation
+    app.middlewares.remove(context_id_hook.middleware)
+    app.middlewares.insert(0, context_id_hook.middleware)
+    app.middlewares.append(tracing.middleware)
+    timer.mark("openapi")
 
-    # Initialize aiohttp_swagger lib
-    def _swagger_def_def_decor(_def_func):
-        def def_func(_request):
-            return web.HTTPFound('/api/openapi.json')
-        return def_func
-    from typing import Optional
-    _swagger_def_def_decor: Optional[...] = _swagger_def_def_decor
-    aiohttp_swagger.setup_swagger(
-        app,
-        swagger_url="/api/docs",
-        swagger_def_decor=_swagger_def_def_decor,
-        ui_version=3,
-    )
+    # Swagger UI is set up on the first visit of the docs
+    LazySwagger("/api/docs").setup(app)
+
+    # Prometheus scrape endpoint
+    app.router.add_get("/metrics", metrics.scrape)
+    metrics.registry.collector("swapchad_startup_seconds", timer.as_dict)
+
+    # On-demand profiling of the worker, enabled by ADMIN_TOKEN
+    app.router.add_post("/admin/profile", profiler.profile)
 
     # Redirect to landing
     async def _landing_redirect(_request):
@@ -116,17 +139,40 @@ async def create_app():
 
     # Serve static files
     app.router.add_static("/", "static")
+    timer.mark("routes")
 
     # Binding startup and shutdown tasks
     app.on_startup.append(create_components)
+    app.on_startup.append(timer.finish)
     app.on_shutdown.append(api_views.disconnect_all)
+    app.on_cleanup.append(dispose_components)
 
     return app
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="SwapChad server")
+    parser.add_argument("--workers", type=int, default=int(getenv("WORKERS", 1)),
+                        help="number of worker processes sharing the port, matchmaking runs in a separate one")
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    web.run_app(create_app(),
-                host=getenv("HOST", "127.0.0.1"),
-                port=getenv("PORT", 80),
-                access_log_format='%a - "%r": %Ts -> %s',
-                access_log_class=context_id_hook.AccessLogClass)
+    args = parse_args()
+    host = getenv("HOST", "127.0.0.1")
+    port = getenv("PORT", 80)
+    run_app_kwargs = {
+        "access_log_format": '%a - "%r": %Ts -> %s',
+        "access_log_class": context_id_hook.AccessLogClass,
+        "shutdown_timeout": float(getenv("SHUTDOWN_TIMEOUT", 60)),
+    }
+    # Abandoned long polls must be cancelled to withdraw the search, aiohttp 3.9+ no longer does it by default
+    if "handler_cancellation" in inspect.signature(web.run_app).parameters:
+        run_app_kwargs["handler_cancellation"] = True
+
+    if args.workers > 1:
+        from workers import Supervisor
+        init_logging()
+        Supervisor(create_app, args.workers, host, port, run_app_kwargs).run()
+    else:
+        web.run_app(create_app(), host=host, port=port, **run_app_kwargs)
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from os import getenv
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+FINISHED_SEARCHES_LIMIT = 10000
+
+
+class Matchmaker:
+    """ Pairs searching users, waiters are kept in FIFO buckets by tag """
+    ANY = "*"
+    WIDEN_AFTER = float(getenv("MATCHMAKING_WIDEN_AFTER", 10))
+    SEARCH_TIMEOUT = float(getenv("SEARCH_TIMEOUT", 0))
+    WAIT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    class AlreadySearchingError(Exception):
+        pass
+
+    class WasNotSearchingError(Exception):
+        pass
+
+    class SearchTimeoutError(Exception):
+        pass
+
+    class Waiter:
+        def __init__(self, user_id, tags):
+            self.user_id = user_id
+            self.tags = tags
+            self.chat_id = None
+            self.event = asyncio.Event()
+            self.started_at = time.monotonic()
+            self.widen_handle = None
+            self.error = None
+
+        def send(self, chat_id):
+            self.chat_id = chat_id
+            self.event.set()
+
+        def fail(self, error):
+            self.error = error
+            self.event.set()
+
+        async def obtain(self):
+            await self.event.wait()
+            if self.error is not None:
+                raise self.error
+            return self.chat_id
+
+    def __init__(self, create_chat):
+        self.create_chat = create_chat
+        self.buckets = {}
+        self.waiters = {}
+        self.wait_times = Histogram(self.WAIT_BUCKETS)
+
+    def __len__(self):
+        return len(self.waiters)
+
+    @staticmethod
+    def normalize_tags(tags):
+        tags = frozenset(tag.strip().lower() for tag in tags if tag.strip())
+        return tags or frozenset([Matchmaker.ANY])
+
+    async def start_search_and_wait(self, user_id, tags=()):
+        """ Returns chat_id of a new chat with matched user, None if aborted; cancelled searches are withdrawn """
+        if user_id in self.waiters:
+            raise self.AlreadySearchingError()
+        tags = self.normalize_tags(tags)
+
+        partner = self.find_partner(tags)
+        if partner is not None:
+            chat_id = self.pair(partner)
+            logger.info("MATCHED WITH WAITING USER, CREATED NEW CHAT %s", chat_id)
+            return chat_id
+
+        waiter = self.Waiter(user_id, tags)
+        self.add(waiter)
+        if self.ANY not in tags:
+            waiter.widen_handle = asyncio.get_running_loop().call_later(self.WIDEN_AFTER, self.widen, waiter)
+
+        logger.info("NO MATCH, WAITING IN %d BUCKET(S)\n...", len(tags))
+
+        try:
+            if self.SEARCH_TIMEOUT > 0:
+                chat_id = await asyncio.wait_for(waiter.obtain(), self.SEARCH_TIMEOUT)
+            else:
+                chat_id = await waiter.obtain()
+        except asyncio.TimeoutError:
+            self.discard(waiter)
+            logger.info("FINISHED WAITING, SEARCH TIMED OUT")
+            raise self.SearchTimeoutError()
+        except asyncio.CancelledError:
+            self.discard(waiter)
+            logger.info("FINISHED WAITING, SEARCH WAS CANCELLED")
+            raise
+
+        if chat_id is None:
+            logger.info("FINISHED WAITING, CHAT NOT FOUND (ABORTED)")
+        else:
+            logger.info("FINISHED WAITING, GOT CHAT %s", chat_id)
+
+        return chat_id
+
+    def find_partner(self, tags):
+        """ Returns the longest waiting user who shares a tag or accepts anyone """
+        partner = None
+        for tag in (tags | {self.ANY}):
+            bucket = self.buckets.get(tag)
+            if bucket:
+                head = next(iter(bucket.values()))
+                if partner is None or head.started_at < partner.started_at:
+                    partner = head
+        return partner
+
+    def pair(self, partner):
+        self.remove(partner)
+        chat_id = self.create_chat()
+        self.wait_times.observe(time.monotonic() - partner.started_at)
+        partner.send(chat_id)
+        return chat_id
+
+    def add(self, waiter):
+        self.waiters[waiter.user_id] = waiter
+        for tag in waiter.tags:
+            self.buckets.setdefault(tag, OrderedDict())[waiter.user_id] = waiter
+
+    def remove(self, waiter):
+        del self.waiters[waiter.user_id]
+        for tag in waiter.tags:
+            bucket = self.buckets[tag]
+            del bucket[waiter.user_id]
+            if not bucket:
+                del self.buckets[tag]
+        if waiter.widen_handle is not None:
+            waiter.widen_handle.cancel()
+            waiter.widen_handle = None
+
+    def discard(self, waiter):
+        """ Removes waiter, unless it has already been matched or aborted """
+        if self.waiters.get(waiter.user_id) is waiter:
+            self.remove(waiter)
+
+    def widen(self, waiter):
+        """ Waiter, who has not been matched by tags in time, accepts anyone from now on """
+        waiter.widen_handle = None
+        any_bucket = self.buckets.get(self.ANY)
+        if any_bucket:
+            partner = next(iter(any_bucket.values()))
+            self.remove(waiter)
+            chat_id = self.pair(partner)
+            self.wait_times.observe(time.monotonic() - waiter.started_at)
+            waiter.send(chat_id)
+            logger.info("MATCHED AFTER WIDENING, CREATED NEW CHAT %s", chat_id)
+            return
+
+        # Waiter keeps its place in the tag buckets
+        waiter.tags = waiter.tags | {self.ANY}
+        self.buckets.setdefault(self.ANY, OrderedDict())[waiter.user_id] = waiter
+
+    def abort_search(self, user_id):
+        waiter = self.waiters.get(user_id)
+        if waiter is None:
+            raise self.WasNotSearchingError()
+        self.remove(waiter)
+        waiter.send(None)
+
+    def abort_all(self):
+        for user_id in list(self.waiters):
+            self.abort_search(user_id)
+
+    def fail_all(self):
+        """ Ends all searches with SearchTimeoutError, so the users search again elsewhere """
+        for waiter in list(self.waiters.values()):
+            self.remove(waiter)
+            waiter.fail(self.SearchTimeoutError())
+
+
+def remember_finished(finished, request_id):
+    """ Keeps ids of recently finished searches, so their late repetitions don't start them again """
+    finished[request_id] = None
+    if len(finished) > FINISHED_SEARCHES_LIMIT:
+        del finished[next(iter(finished))]
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from os import getenv
+
+from sqlalchemy import insert, update
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBuffer:
+    """ Write-behind buffer, persists messages of a saved chat to the DB in batches """
+    MAX_MESSAGES = int(getenv("MESSAGE_BUFFER_MAX_MESSAGES", 100))
+    MAX_DELAY = float(getenv("MESSAGE_BUFFER_MAX_DELAY", 1.0))
+    MAX_RETRIES = 3
+
+    class Stats:
+        """ Flush counters, shared by all buffers of the process """
+        def __init__(self):
+            self.flushes = 0
+            self.flushed_messages = 0
+            self.max_flush_size = 0
+            self.flush_seconds = 0.0
+            self.max_flush_seconds = 0.0
+            self.failures = 0
+
+        def record(self, size, seconds):
+            self.flushes += 1
+            self.flushed_messages += size
+            self.max_flush_size = max(self.max_flush_size, size)
+            self.flush_seconds += seconds
+            self.max_flush_seconds = max(self.max_flush_seconds, seconds)
+
+        def as_dict(self):
+            return {
+                "flushes": self.flushes,
+                "flushed_messages": self.flushed_messages,
+                "max_flush_size": self.max_flush_size,
+                "avg_flush_size": (self.flushed_messages / self.flushes if self.flushes else 0),
+                "flush_seconds": self.flush_seconds,
+                "max_flush_seconds": self.max_flush_seconds,
+                "failures": self.failures,
+            }
+
+    stats = Stats()
+
+    def __init__(self, chat_id, session_factory, persisted_id=0):
+        self.chat_id = chat_id
+        self.session_factory = session_factory
+        self.persisted_id = persisted_id
+        self.pending = []
+        self.offsets = {}
+        self.lock = asyncio.Lock()
+        self.timer = None
+        self.flush_task = None
+        self.retries = 0
+
+    def push(self, message):
+        """ Queues message for saving, flush happens when either size or time threshold is reached """
+        self.pending.append(message)
+        if len(self.pending) >= self.MAX_MESSAGES:
+            self.schedule_flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.MAX_DELAY, self.schedule_flush)
+
+    def set_offset(self, user_id, offset):
+        """ Queues update of the user's read position, it is written along with the next batch """
+        self.offsets[user_id] = offset
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.MAX_DELAY, self.schedule_flush)
+
+    def schedule_flush(self):
+        self.cancel_timer()
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush())
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    async def flush(self):
+        """ Writes all queued messages and read positions to the DB """
+        self.cancel_timer()
+        async with self.lock:
+            while self.pending or self.offsets:
+                batch, self.pending = self.pending, []
+                offsets, self.offsets = self.offsets, {}
+                started = time.perf_counter()
+                try:
+                    # Short-lived session holds a pooled connection only for the duration of the flush
+                    async with self.session_factory() as session:
+                        if batch:
+                            await session.execute(insert(db.Message.__table__),
+                                                  [message.row(self.chat_id) for message in batch])
+                        for user_id, offset in offsets.items():
+                            await session.execute(update(db.SavedChat.__table__)
+                                                  .filter_by(chat_id=self.chat_id, user_id=user_id)
+                                                  .values(offset=offset))
+                        await session.commit()
+                except Exception:
+                    self.stats.failures += 1
+                    self.retries += 1
+                    if self.retries > self.MAX_RETRIES:
+                        logger.exception("CHAT %s: DROPPED %d MESSAGES AFTER %d FAILED FLUSHES",
+                                         self.chat_id, len(batch), self.retries)
+                        self.retries = 0
+                        continue
+                    logger.exception("CHAT %s: FAILED TO FLUSH %d MESSAGES, WILL RETRY", self.chat_id, len(batch))
+                    self.pending[:0] = batch
+                    self.offsets = {**offsets, **self.offsets}
+                    if self.timer is None:
+                        self.timer = asyncio.get_running_loop().call_later(self.MAX_DELAY, self.schedule_flush)
+                    return
+
+                self.retries = 0
+                if not batch:
+                    continue
+                self.persisted_id = max(self.persisted_id, batch[-1].message_id)
+                elapsed = time.perf_counter() - started
+                self.stats.record(len(batch), elapsed)
+                logger.debug("CHAT %s: FLUSHED %d MESSAGES IN %.4fs", self.chat_id, len(batch), elapsed)
+
+
+metrics.registry.collector("swapchad_message_buffer", MessageBuffer.stats.as_dict)
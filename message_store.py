@@ -0,0 +1,135 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+import json_codec
+
+
+class MessageStore:
+    """ Chat messages kept in parallel arrays, authors are interned as small indexes """
+    def __init__(self, participants=None):
+        self.ids = array("q")
+        self.authors = array("H")
+        self.texts = []
+        self.participants = participants if participants is not None else []
+        self.views = {}
+
+    class View:
+        """ Messages already encoded from a participant's perspective, each one is followed by a comma """
+        def __init__(self, is_own):
+            self.is_own = is_own
+            self.buffer = bytearray()
+            self.offsets = array("Q")
+
+        def append(self, message_id, author, text):
+            self.offsets.append(len(self.buffer))
+            self.buffer += b'{"message_id":%d,"from":%s,"text":%s},' % (
+                message_id,
+                (b'"YOU"' if self.is_own(author) else b'"ANON"'),
+                json_codec.dumps_bytes(text),
+            )
+
+        def drop_first(self, count):
+            if count >= len(self.offsets):
+                self.buffer.clear()
+                del self.offsets[:]
+                return
+            shift = self.offsets[count]
+            del self.buffer[:shift]
+            del self.offsets[:count]
+            for i in range(len(self.offsets)):
+                self.offsets[i] -= shift
+
+        def size(self):
+            return len(self.buffer) + self.offsets.itemsize * len(self.offsets)
+
+        def frame(self, start, end):
+            if start >= end:
+                return "[]"
+            stop = (self.offsets[end] if end < len(self.offsets) else len(self.buffer)) - 1
+            return "[" + self.buffer[self.offsets[start]:stop].decode("utf-8") + "]"
+
+    @staticmethod
+    def from_rows(rows):
+        """ Builds store from (message_id, user_id, text) rows ordered by message_id """
+        store = MessageStore()
+        for message_id, user_id, text in rows:
+            store.append(message_id, user_id, text)
+        return store
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return self.rows()
+
+    def intern(self, user_id):
+        try:
+            return self.participants.index(user_id)
+        except ValueError:
+            self.participants.append(user_id)
+            return len(self.participants) - 1
+
+    def append(self, message_id, user_id, text):
+        author = self.intern(user_id)
+        self.ids.append(message_id)
+        self.authors.append(author)
+        self.texts.append(text)
+        for view in self.views.values():
+            view.append(message_id, author, text)
+
+    def extend(self, other):
+        """ Appends messages of another store, which may have its own participants """
+        mapping = [self.intern(user_id) for user_id in other.participants]
+        self.ids.extend(other.ids)
+        self.authors.extend(mapping[author] for author in other.authors)
+        self.texts.extend(other.texts)
+        self.views.clear()
+
+    def rows(self, start=0, end=None):
+        """ Yields (message_id, user_id, text) tuples """
+        participants = self.participants
+        for message_id, author, text in zip(self.ids[start:end], self.authors[start:end], self.texts[start:end]):
+            yield message_id, participants[author], text
+
+    def slice(self, start, end):
+        """ Returns copy of the messages in [start, end) sharing interned participants with this store """
+        part = MessageStore(self.participants)
+        part.ids = self.ids[start:end]
+        part.authors = self.authors[start:end]
+        part.texts = self.texts[start:end]
+        return part
+
+    def index_after(self, message_id):
+        return bisect_right(self.ids, message_id)
+
+    def index_before(self, message_id):
+        return bisect_left(self.ids, message_id)
+
+    def drop_first(self, count):
+        del self.ids[:count]
+        del self.authors[:count]
+        del self.texts[:count]
+        for view in self.views.values():
+            view.drop_first(count)
+
+    def get_view(self, user_id):
+        """ Returns encoded messages from the user's perspective, view is kept up to date on append """
+        view = self.views.get(user_id)
+        if view is None:
+            participants = self.participants
+            view = self.View(lambda author: participants[author] == user_id)
+            for message_id, author, text in zip(self.ids, self.authors, self.texts):
+                view.append(message_id, author, text)
+            self.views[user_id] = view
+        return view
+
+    def drop_view(self, user_id):
+        self.views.pop(user_id, None)
+
+    def view_bytes(self):
+        return sum(view.size() for view in self.views.values())
+
+    def encode(self, user_id, start=0, end=None):
+        """ Serializes messages in [start, end) to JSON from the user's perspective """
+        end = len(self.ids) if end is None else end
+        return self.get_view(user_id).frame(start, end)
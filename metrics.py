@@ -0,0 +1,156 @@
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+
+# Seconds, from a fast in-memory operation to a slow DB roundtrip
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    """ Monotonically growing value """
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """ Value, which is either set directly or read from the function at scrape time """
+    def __init__(self, func=None):
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.func() if self.func is not None else self.value
+
+
+class Histogram:
+    """ Counts observations into buckets with fixed upper bounds """
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def as_dict(self):
+        buckets = {str(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets["+Inf"] = self.counts[-1]
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class HistogramFamily:
+    """ Histograms with the same bounds, one per value of the label """
+    def __init__(self, label, bounds):
+        self.label = label
+        self.bounds = bounds
+        self.children = {}
+
+    def observe(self, label_value, value):
+        histogram = self.children.get(label_value)
+        if histogram is None:
+            histogram = self.children[label_value] = Histogram(self.bounds)
+        histogram.observe(value)
+
+
+class Registry:
+    """ Named metrics and collectors of existing stats, rendered in Prometheus text format """
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = {}
+
+    def register(self, name, description, metric):
+        self.metrics[name] = (description, metric)
+        return metric
+
+    def counter(self, name, description):
+        return self.register(name, description, Counter())
+
+    def gauge(self, name, description, func=None):
+        return self.register(name, description, Gauge(func))
+
+    def histogram(self, name, description, bounds=LATENCY_BUCKETS):
+        return self.register(name, description, Histogram(bounds))
+
+    def histogram_family(self, name, description, label, bounds=LATENCY_BUCKETS):
+        return self.register(name, description, HistogramFamily(label, bounds))
+
+    def collector(self, prefix, func):
+        """ Exposes numbers of the dict returned by the function, nested keys are joined with underscores """
+        self.collectors[prefix] = func
+
+    def render(self):
+        lines = []
+        for name, (description, metric) in self.metrics.items():
+            lines.append(f"# HELP {name} {description}")
+            if isinstance(metric, Counter):
+                lines += [f"# TYPE {name} counter", f"{name} {metric.value}"]
+            elif isinstance(metric, Gauge):
+                lines += [f"# TYPE {name} gauge", f"{name} {metric.get()}"]
+            elif isinstance(metric, Histogram):
+                lines.append(f"# TYPE {name} histogram")
+                lines += self.render_histogram(name, metric)
+            elif isinstance(metric, HistogramFamily):
+                lines.append(f"# TYPE {name} histogram")
+                for label_value, histogram in metric.children.items():
+                    lines += self.render_histogram(name, histogram, f'{metric.label}="{label_value}"')
+        for prefix, func in self.collectors.items():
+            for name, value in self.flatten(prefix, func()):
+                lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def render_histogram(name, histogram, labels=""):
+        separator = "," if labels else ""
+        cumulative = 0
+        for bound, count in zip(histogram.bounds + ["+Inf"], histogram.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}'
+        labels = f"{{{labels}}}" if labels else ""
+        yield f"{name}_sum{labels} {histogram.sum}"
+        yield f"{name}_count{labels} {histogram.count}"
+
+    @staticmethod
+    def flatten(prefix, stats):
+        for key, value in stats.items():
+            name = f"{prefix}_{key}"
+            if isinstance(value, dict):
+                yield from Registry.flatten(name, value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield name, value
+
+
+registry = Registry()
+
+http_latency = registry.histogram_family("swapchad_http_request_seconds",
+                                         "HTTP request latency by OpenAPI operation", "operation")
+http_requests = registry.counter("swapchad_http_requests_total", "HTTP requests handled, websockets included")
+
+
+@web.middleware
+async def middleware(request, handler):
+    """ Records latency of API requests by operationId, websocket connections are only counted """
+    http_requests.inc()
+    mapping = getattr(handler, "__rororo_openapi_mapping__", None)
+    if not mapping or request.headers.get("Upgrade", "").lower() == "websocket":
+        return await handler(request)
+
+    started = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        http_latency.observe(mapping.get(request.method) or mapping.get("*"), time.perf_counter() - started)
+
+
+async def scrape(_request):
+    return web.Response(body=registry.render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
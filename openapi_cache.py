@@ -0,0 +1,73 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+from os import getenv
+from pathlib import Path
+
+from jsonschema.validators import RefResolver
+from openapi_core.schema.specs.factories import SpecFactory
+from openapi_spec_validator import default_handlers
+from rororo.openapi.openapi import read_openapi_schema
+
+logger = logging.getLogger(__name__)
+
+ENABLED = getenv("OPENAPI_CACHE", "1") == "1"
+# Inside the app directory by default, so the cache warmed during the build ships with the image
+CACHE_DIR = Path(getenv("OPENAPI_CACHE_DIR", Path(__file__).parent / ".openapi_cache"))
+
+
+def cache_path(path):
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    return CACHE_DIR / f"{path.stem}-{digest}.json"
+
+
+def create_spec(schema, validate):
+    """ Same as openapi_core.shortcuts.create_spec, but validation of the schema can be skipped """
+    resolver = RefResolver("", schema, handlers=default_handlers)
+    return SpecFactory(resolver, config={"validate_spec": validate}).create(schema)
+
+
+def store(cached, schema):
+    # Written under a temporary name first, so concurrently booting workers never read a partial file
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        temp_path = cached.with_suffix(f".{os.getpid()}.tmp")
+        temp_path.write_text(json.dumps(schema), encoding="utf-8")
+        os.replace(temp_path, cached)
+        for stale in CACHE_DIR.glob(f"{cached.stem.rsplit('-', 1)[0]}-*.json"):
+            if stale != cached:
+                stale.unlink(missing_ok=True)
+    except OSError as exc:
+        logger.warning("OPENAPI CACHE %s IS NOT WRITABLE: %s", CACHE_DIR, exc)
+
+
+def load_schema_and_spec(path):
+    """ Returns schema and spec for rororo, schema is validated only once per content of the file """
+    if not ENABLED:
+        schema = read_openapi_schema(path)
+        return schema, create_spec(schema, validate=True)
+
+    cached = cache_path(path)
+    try:
+        schema = json.loads(cached.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        schema = None
+
+    if schema is not None:
+        logger.debug("OPENAPI SCHEMA LOADED FROM %s", cached)
+        return schema, create_spec(schema, validate=False)
+
+    schema = read_openapi_schema(path)
+    spec = create_spec(schema, validate=True)
+    store(cached, schema)
+    logger.info("OPENAPI SCHEMA VALIDATED AND CACHED IN %s", cached)
+    return schema, spec
+
+
+if __name__ == "__main__":
+    # Warms the cache, e.g. during the image build
+    logging.basicConfig(level=logging.INFO)
+    for argument in sys.argv[1:] or [Path(__file__).parent / "openapi.yaml"]:
+        load_schema_and_spec(Path(argument))
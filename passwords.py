@@ -0,0 +1,70 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from os import getenv
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * r * (n + p), dklen=32)
+
+
+class PasswordHasher:
+    """ Hashes passwords with scrypt on a thread or process pool, so the event loop is not blocked """
+    SCHEME = "scrypt"
+
+    POOL = getenv("PASSWORD_HASH_POOL", "thread")
+    WORKERS = int(getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+    N = int(getenv("PASSWORD_SCRYPT_N", 2 ** 14))
+    R = int(getenv("PASSWORD_SCRYPT_R", 8))
+    P = int(getenv("PASSWORD_SCRYPT_P", 1))
+
+    def __init__(self, pool=None, workers=None, n=None, r=None, p=None):
+        self.pool = pool or self.POOL
+        self.workers = workers or self.WORKERS
+        self.n = n or self.N
+        self.r = r or self.R
+        self.p = p or self.P
+        self.executor = None
+
+    def get_executor(self):
+        if self.executor is None:
+            executor_class = (ProcessPoolExecutor if self.pool == "process" else ThreadPoolExecutor)
+            self.executor = executor_class(max_workers=self.workers)
+        return self.executor
+
+    async def run(self, password, salt, n, r, p):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_executor(), _scrypt, password, salt, n, r, p)
+
+    async def hash(self, password):
+        """ Returns "scrypt$n$r$p$salt$hash" string to be stored in the DB """
+        salt = os.urandom(16)
+        digest = await self.run(password, salt, self.n, self.r, self.p)
+        return "$".join([self.SCHEME, str(self.n), str(self.r), str(self.p),
+                         base64.b64encode(salt).decode(), base64.b64encode(digest).decode()])
+
+    async def verify(self, stored, password):
+        """ Checks password against the stored one, returns (matches, needs_rehash) """
+        # Rows created before hashing was introduced hold the password itself
+        if not stored.startswith(self.SCHEME + "$"):
+            matches = hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+            return matches, matches
+
+        try:
+            _, n, r, p, salt, digest = stored.split("$")
+            n, r, p = int(n), int(r), int(p)
+            salt, digest = base64.b64decode(salt), base64.b64decode(digest)
+        except ValueError:
+            return False, False
+
+        matches = hmac.compare_digest(await self.run(password, salt, n, r, p), digest)
+        return matches, matches and (n, r, p) != (self.n, self.r, self.p)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -0,0 +1,93 @@
+from os import getenv
+
+from sqlalchemy import select
+
+import db
+import metrics
+from cache import LRUCache
+
+
+class ProfileCache:
+    """ Read-through cache of user profiles, looked up either by user_id or by username """
+    MAX_SIZE = int(getenv("PROFILE_CACHE_SIZE", 10000))
+    TTL = float(getenv("PROFILE_CACHE_TTL", 60))
+
+    class Profile:
+        __slots__ = ("user_id", "username", "displayed_name")
+
+        def __init__(self, user_id, username, displayed_name):
+            self.user_id = user_id
+            self.username = username
+            self.displayed_name = displayed_name
+
+    def __init__(self):
+        self.by_user_id = LRUCache(self.MAX_SIZE, self.TTL)
+        self.by_username = LRUCache(self.MAX_SIZE, self.TTL)
+        # Generation at which each user was last invalidated, kept only while some DB read is running
+        self.generation = 0
+        self.invalidated_at = {}
+        self.reads = 0
+
+    async def get(self, session, user_id=None, username=None):
+        """ Returns cached profile or loads it from the DB, None if there is no such user """
+        cache, key = ((self.by_user_id, user_id) if user_id is not None else (self.by_username, username))
+        profile = cache.get(key)
+        if profile is not None:
+            return profile
+
+        query = (select(db.User.user_id, db.User.username, db.User.displayed_name)
+                 .filter_by(**({"user_id": user_id} if user_id is not None else {"username": username})))
+        started_at = self.generation
+        self.reads += 1
+        try:
+            row = (await session.execute(query)).one_or_none()
+        finally:
+            self.reads -= 1
+        invalidated_at = (self.invalidated_at.get(row[0], -1) if row is not None else -1)
+        if not self.reads:
+            self.invalidated_at.clear()
+        if row is None:
+            return None
+
+        profile = self.Profile(*row)
+        if invalidated_at >= started_at:
+            # The user was changed during the read, the row may predate the change
+            return profile
+        self.by_user_id.set(profile.user_id, profile)
+        self.by_username.set(profile.username, profile)
+        return profile
+
+    def invalidate(self, user_id, *usernames):
+        """ Forgets profile of the user, usernames it was or is going to be known by are forgotten too """
+        self.bump(user_id)
+        profile = self.by_user_id.pop(user_id)
+        if profile is not None:
+            self.by_username.pop(profile.username)
+        for username in usernames:
+            self.by_username.pop(username)
+
+    def invalidate_deleted(self, user_id):
+        """ Forgets profile of the deleted user, including entries cached only by username """
+        self.bump(user_id)
+        self.by_user_id.pop(user_id)
+        self.by_username.remove_if(lambda profile: profile.user_id == user_id)
+
+    def bump(self, user_id):
+        """ Keeps reads, which are running now, from caching the user """
+        if self.reads:
+            self.invalidated_at[user_id] = self.generation
+            self.generation += 1
+
+    def clear(self):
+        self.by_user_id.clear()
+        self.by_username.clear()
+
+    def get_stats(self):
+        return {
+            "by_user_id": self.by_user_id.get_stats(),
+            "by_username": self.by_username.get_stats(),
+        }
+
+
+profiles = ProfileCache()
+metrics.registry.collector("swapchad_profile_cache", profiles.get_stats)
@@ -0,0 +1,111 @@
+import asyncio
+import cProfile
+import hmac
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from os import getenv
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+ADMIN_TOKEN = getenv("ADMIN_TOKEN")
+MAX_SECONDS = float(getenv("PROFILE_MAX_SECONDS", 60))
+SAMPLE_INTERVAL = float(getenv("PROFILE_SAMPLE_INTERVAL", 0.005))
+TOP = 50
+
+running = False
+
+
+class StackSampler:
+    """ Collects stacks of the event loop thread from a background thread, without slowing down the loop itself """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def render(self):
+        """ Collapsed stacks, the format flame graph tools take """
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def render_stats(profile, top):
+    output = io.StringIO()
+    pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(top)
+    return output.getvalue()
+
+
+def is_authorized(request):
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return scheme == "Bearer" and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+async def profile(request):
+    """ Profiles this worker for the given number of seconds, mode is either cprofile or sample """
+    global running
+    if not ADMIN_TOKEN:
+        raise web.HTTPNotFound()
+    if not is_authorized(request):
+        raise web.HTTPUnauthorized()
+
+    try:
+        seconds = min(float(request.query.get("seconds", 10)), MAX_SECONDS)
+        top = int(request.query.get("top", TOP))
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds and top must be numbers")
+    mode = request.query.get("mode", "cprofile")
+    if mode not in ("cprofile", "sample"):
+        raise web.HTTPBadRequest(text="mode must be cprofile or sample")
+    if running:
+        raise web.HTTPConflict(text="Profiling is already running")
+
+    running = True
+    logger.warning("PROFILING (%s) FOR %.1fs", mode.upper(), seconds)
+    started_at = time.perf_counter()
+    try:
+        if mode == "cprofile":
+            # Deterministic profiler sees every call of the loop thread, so it slows the worker down noticeably
+            collector = cProfile.Profile()
+            collector.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                collector.disable()
+            text = render_stats(collector, top)
+        else:
+            sampler = StackSampler(threading.get_ident(), SAMPLE_INTERVAL)
+            sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                sampler.stop()
+            text = sampler.render()
+    finally:
+        running = False
+    logger.warning("PROFILING FINISHED IN %.1fs", time.perf_counter() - started_at)
+    return web.Response(text=text)
@@ -0,0 +1,45 @@
+import logging
+import time
+from importlib.util import find_spec
+from pathlib import Path
+
+from aiohttp import hdrs, web
+
+logger = logging.getLogger(__name__)
+
+DOCS_URL = "/api/docs"
+SCHEMA_URL = "/api/openapi.json"
+
+
+class LazySwagger:
+    """ Swagger UI, aiohttp_swagger is imported and renders its page on the first visit of the docs """
+    def __init__(self, url):
+        self.url = url
+        self.page = None
+
+    def setup(self, app):
+        # Static files are served straight from the package directory, which is found without importing it
+        static_path = Path(find_spec("aiohttp_swagger").submodule_search_locations[0]) / "swagger_ui3"
+        app.router.add_get(self.url, self.home)
+        app.router.add_get(f"{self.url}/", self.home)
+        app.router.add_get(f"{self.url}/swagger.json", self.definition)
+        app.router.add_static(f"{self.url}/swagger_static", static_path)
+
+    def render(self):
+        started_at = time.perf_counter()
+        import aiohttp_swagger
+        docs = web.Application()
+        # Definition is never generated from docstrings, the page is pointed to the OpenAPI schema instead
+        aiohttp_swagger.setup_swagger(docs, swagger_url=self.url, swagger_info={}, ui_version=3)
+        logger.info("SWAGGER UI SET UP IN %.1fms", (time.perf_counter() - started_at) * 1000)
+        return docs["SWAGGER_TEMPLATE_CONTENT"]
+
+    async def home(self, _request):
+        if self.page is None:
+            self.page = self.render()
+        return web.Response(text=self.page, content_type="text/html")
+
+    @staticmethod
+    async def definition(_request):
+        # Returned as a plain response, error_middleware logs every raised HTTP exception as an error
+        return web.Response(status=302, headers={hdrs.LOCATION: SCHEMA_URL})
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import uuid
+
+from aiohttp import WSCloseCode, WSMsgType
+
+from broadcast import BroadcastStats, Outbox
+from chat import Chat
+
+
+class WebSocket:
+    """ Records sent frames, sending waits until the client is ready to read """
+    def __init__(self, ready=True, fails=False):
+        self.sent = []
+        self.close_code = None
+        self.fails = fails
+        self.ready = asyncio.Event()
+        if ready:
+            self.ready.set()
+
+    @property
+    def closed(self):
+        return self.close_code is not None
+
+    async def send_str(self, frame):
+        await self.ready.wait()
+        if self.fails:
+            raise ConnectionResetError("Connection lost")
+        self.sent.append(frame)
+
+    async def close(self, code, message=b""):
+        self.close_code = code
+        return True
+
+
+def make_outbox(ws, policy, max_size=2):
+    return Outbox(ws, BroadcastStats(), policy=policy, max_size=max_size)
+
+
+def test_frames_are_sent_in_order():
+    async def run():
+        ws = WebSocket()
+        outbox = make_outbox(ws, Outbox.DROP)
+        outbox.send("history")
+        outbox.send_message(1, "hello")
+        await asyncio.sleep(0)
+        assert ws.sent == ["history", "hello"]
+        assert outbox.stats.sent == 2
+        outbox.close()
+    asyncio.run(run())
+
+
+def test_drop_policy_drops_frames_over_the_limit():
+    async def run():
+        ws = WebSocket(ready=False)
+        outbox = make_outbox(ws, Outbox.DROP)
+        for number in range(4):
+            outbox.send_message(number, f"message {number}")
+        ws.ready.set()
+        await asyncio.sleep(0)
+        assert ws.sent == ["message 0", "message 1"]
+        assert outbox.stats.dropped == 2
+        outbox.close()
+    asyncio.run(run())
+
+
+def test_coalesce_policy_merges_messages_into_a_tagged_batch():
+    async def run():
+        ws = WebSocket(ready=False)
+        outbox = make_outbox(ws, Outbox.COALESCE)
+        outbox.send("history")
+        outbox.send_message(1, "first")
+        outbox.send_message(2, 'second "quoted"')
+        outbox.send_message(3, "third")
+        ws.ready.set()
+        await asyncio.sleep(0)
+
+        assert ws.sent[0] == "history"
+        assert ws.sent[1].startswith(Outbox.BATCH)
+        assert json.loads(ws.sent[1][len(Outbox.BATCH):]) == [
+            {"message_id": 1, "from": "ANON", "text": "first"},
+            {"message_id": 2, "from": "ANON", "text": 'second "quoted"'},
+            {"message_id": 3, "from": "ANON", "text": "third"},
+        ]
+        assert outbox.stats.coalesced == 2
+        outbox.close()
+    asyncio.run(run())
+
+
+def test_coalesce_policy_never_merges_other_frames():
+    async def run():
+        ws = WebSocket(ready=False)
+        outbox = make_outbox(ws, Outbox.COALESCE)
+        outbox.send_message(1, "first")
+        outbox.send("history")
+        outbox.send_message(2, "second")
+        outbox.send("ANON HAD LEFT")
+        ws.ready.set()
+        await asyncio.sleep(0)
+        assert ws.sent == ["first", "history"]
+        assert outbox.stats.dropped == 2
+        assert outbox.stats.coalesced == 0
+        outbox.close()
+    asyncio.run(run())
+
+
+def test_disconnect_policy_closes_websocket_from_the_writer():
+    async def run():
+        ws = WebSocket(ready=False)
+        outbox = make_outbox(ws, Outbox.DISCONNECT)
+        for number in range(3):
+            outbox.send_message(number, f"message {number}")
+        outbox.send("late")
+        await asyncio.sleep(0)
+        assert ws.close_code == WSCloseCode.TRY_AGAIN_LATER
+        assert outbox.task.done() and outbox.task.exception() is None
+        assert outbox.stats.disconnected == 1
+        assert len(outbox) == 0
+    asyncio.run(run())
+
+
+def test_failed_send_closes_websocket_and_stops_queueing():
+    async def run():
+        ws = WebSocket(fails=True)
+        outbox = make_outbox(ws, Outbox.DROP)
+        outbox.send("first")
+        await asyncio.sleep(0)
+        assert ws.close_code == WSCloseCode.INTERNAL_ERROR
+        outbox.send("second")
+        assert len(outbox) == 0
+        assert outbox.stats.dropped == 1
+    asyncio.run(run())
+
+
+class ClientWebSocket(WebSocket):
+    """ Websocket of a chat client, which sends the given frames and then waits until it is closed """
+    def __init__(self, frames):
+        super().__init__()
+        self.incoming = asyncio.Queue()
+        for frame in frames:
+            self.incoming.put_nowait(frame)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        frame = await self.incoming.get()
+        if frame is None:
+            raise StopAsyncIteration
+        return type("Message", (), {"type": WSMsgType.TEXT, "data": frame})
+
+    def leave(self):
+        self.incoming.put_nowait(None)
+
+
+def test_chat_relays_messages_but_not_control_frames():
+    async def run():
+        alice, bob = uuid.uuid4(), uuid.uuid4()
+        chat = Chat(uuid.uuid4(), None)
+        bob_ws = ClientWebSocket([])
+        alice_ws = ClientWebSocket(["hello", Outbox.BATCH + "[]", "\0HISTORY 2"])
+        bob_joined = asyncio.create_task(chat.proceed(bob, bob_ws))
+        await asyncio.sleep(0.01)
+        alice_joined = asyncio.create_task(chat.proceed(alice, alice_ws))
+        await asyncio.sleep(0.01)
+
+        assert bob_ws.sent == ["[]", "hello"]
+        assert alice_ws.sent[0] == "[]"
+        assert alice_ws.sent[1] == "\0HISTORY" + json.dumps([{"message_id": 1, "from": "YOU", "text": "hello"}],
+                                                            separators=(",", ":"))
+        alice_ws.leave()
+        bob_ws.leave()
+        await asyncio.gather(alice_joined, bob_joined)
+        assert chat.clients == {}
+    asyncio.run(run())
@@ -0,0 +1,111 @@
+import time
+import uuid
+
+import jwt
+import pytest
+
+from auth import Auth
+from cache import LRUCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = LRUCache(2, 60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+    assert cache.get_stats()["evictions"] == 1
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = LRUCache(10, 60)
+    cache.set("a", 1)
+    clock[0] += 59
+    assert cache.get("a") == 1
+    clock[0] += 2
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_entry_ttl_is_capped_by_the_cache_ttl(clock):
+    cache = LRUCache(10, 60)
+    cache.set("short", 1, ttl=5)
+    cache.set("long", 2, ttl=3600)
+    clock[0] += 10
+    assert cache.get("short") is None
+    assert cache.get("long") == 2
+    clock[0] += 60
+    assert cache.get("long") is None
+
+
+def test_zero_size_cache_stores_nothing():
+    cache = LRUCache(0, 60)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_pop_and_remove_if():
+    cache = LRUCache(10, 60)
+    for key, value in [("a", 1), ("b", 2), ("c", 1)]:
+        cache.set(key, value)
+    assert cache.pop("b") == 2
+    assert cache.pop("b") is None
+    cache.remove_if(lambda value: value == 1)
+    assert len(cache) == 0
+
+
+def test_stats_count_hits_and_misses():
+    cache = LRUCache(10, 60)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("b")
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+
+
+@pytest.fixture
+def tokens(monkeypatch):
+    monkeypatch.setattr(Auth, "verified_tokens", LRUCache(10, 300))
+    return Auth.verified_tokens
+
+
+def test_verified_token_is_cached(tokens):
+    user_id = uuid.uuid4()
+    token = Auth.issue_token(user_id)
+    assert Auth.verify(token) == user_id
+    assert tokens.get(token) == user_id
+
+
+def test_invalid_token_is_not_cached(tokens):
+    with pytest.raises(Auth.InvalidToken):
+        Auth.verify("not a token")
+    assert len(tokens) == 0
+
+
+def test_cached_token_does_not_outlive_its_expiration(tokens, clock):
+    user_id = uuid.uuid4()
+    token = jwt.encode({"user_id": user_id.hex, "exp": int(time.time()) + 30}, Auth.JWT_SECRET, algorithm="HS256")
+    Auth.verify(token)
+    clock[0] += 31
+    assert tokens.get(token) is None
+
+
+def test_tokens_of_invalidated_user_are_forgotten(tokens):
+    user_id, other_id = uuid.uuid4(), uuid.uuid4()
+    Auth.verify(Auth.issue_token(user_id))
+    Auth.verify(Auth.issue_token(other_id))
+    Auth.invalidate_user(user_id)
+    assert list(tokens.entries.values())[0][0] == other_id
+    assert len(tokens) == 1
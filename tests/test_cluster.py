@@ -0,0 +1,145 @@
+""" Two app instances in cluster mode against the Postgres of DATABASE_URL, run it against a scratch database """
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import uuid
+from pathlib import Path
+
+import aiohttp
+import asyncpg
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+pytestmark = pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="DATABASE_URL is not set")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def urls():
+    ports = [free_port(), free_port()]
+    instances = [
+        subprocess.Popen([sys.executable, "main.py"], cwd=ROOT,
+                         env=dict(os.environ, CLUSTER_MODE="1", PORT=str(port), CLUSTER_ELECTION_INTERVAL="0.5"),
+                         stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        for port in ports
+    ]
+    try:
+        urls = [f"http://127.0.0.1:{port}" for port in ports]
+        asyncio.run(wait_until_ready(urls))
+        yield urls
+    finally:
+        for instance in instances:
+            instance.terminate()
+        for instance in instances:
+            instance.wait(timeout=15)
+
+
+async def wait_until_ready(urls, timeout=30):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    async with aiohttp.ClientSession() as session:
+        for url in urls:
+            while True:
+                try:
+                    async with session.get(url + "/api/openapi.json"):
+                        break
+                except aiohttp.ClientConnectionError:
+                    if loop.time() > deadline:
+                        raise
+                    await asyncio.sleep(0.5)
+    # Let one of the instances become the matchmaker
+    await asyncio.sleep(1)
+
+
+async def sign_up(session, url):
+    username = "test_" + uuid.uuid4().hex[:12]
+    async with session.post(url + "/api/auth/signup",
+                            json={"displayed_name": username, "username": username, "password": "test"}) as response:
+        assert response.status == 200
+        return (await response.json())["token"]
+
+
+async def start_search(session, url, token):
+    async with session.post(url + "/api/chats/start-search", headers={"Authorization": "Bearer " + token}) as response:
+        assert response.status == 200
+        return (await response.json())["chat_id"]
+
+
+async def join(session, url, token, chat_id):
+    ws = await session.ws_connect(url.replace("http", "ws", 1) + "/api/chat/" + chat_id)
+    await ws.send_str(token)
+    await ws.receive_str(timeout=5)  # History
+    return ws
+
+
+async def match_and_chat(url_a, url_b):
+    async with aiohttp.ClientSession() as session:
+        token_a, token_b = await sign_up(session, url_a), await sign_up(session, url_b)
+        chat_a, chat_b = await asyncio.wait_for(asyncio.gather(
+            start_search(session, url_a, token_a),
+            start_search(session, url_b, token_b),
+        ), 10)
+        assert chat_a == chat_b
+
+        ws_a = await join(session, url_a, token_a, chat_a)
+        ws_b = await join(session, url_b, token_b, chat_b)
+        try:
+            await ws_a.send_str("hello from A")
+            assert await ws_b.receive_str(timeout=5) == "hello from A"
+            await ws_b.send_str("hello from B")
+            assert await ws_a.receive_str(timeout=5) == "hello from B"
+
+            async with session.post(url_b + f"/api/chat/{chat_b}/save", json={"title": "test"},
+                                    headers={"Authorization": "Bearer " + token_b}) as response:
+                assert response.status == 200
+            await ws_a.send_str("after save")
+            assert await ws_b.receive_str(timeout=5) == "after save"
+        finally:
+            await ws_a.close()
+            await ws_b.close()
+
+
+def test_users_of_different_instances_are_matched_and_chat(urls):
+    asyncio.run(match_and_chat(*urls))
+
+
+async def search_and_abort_elsewhere(url_a, url_b):
+    async with aiohttp.ClientSession() as session:
+        token = await sign_up(session, url_a)
+        headers = {"Authorization": "Bearer " + token}
+        search = asyncio.create_task(session.post(url_a + "/api/chats/start-search", headers=headers))
+        await asyncio.sleep(1)
+        async with session.post(url_b + "/api/chats/abort-search", headers=headers) as response:
+            assert response.status == 200
+        async with await asyncio.wait_for(search, 5) as response:
+            assert response.status == 422
+            assert "Search was aborted" in await response.text()
+
+
+def test_search_is_aborted_through_another_instance(urls):
+    asyncio.run(search_and_abort_elsewhere(*urls))
+
+
+async def terminate_bus_connections():
+    dsn = os.environ["DATABASE_URL"].replace("postgresql+asyncpg://", "postgresql://", 1)
+    connection = await asyncpg.connect(dsn)
+    try:
+        return await connection.fetchval("SELECT count(pg_terminate_backend(pid)) FROM pg_stat_activity"
+                                         " WHERE application_name = 'swapchad-bus'")
+    finally:
+        await connection.close()
+
+
+def test_instances_reconnect_after_bus_connections_are_lost(urls):
+    assert asyncio.run(terminate_bus_connections()) == 2
+    # Reconnection and the next election of the matchmaker
+    asyncio.run(asyncio.sleep(3))
+    asyncio.run(match_and_chat(*urls))
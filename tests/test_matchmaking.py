@@ -0,0 +1,160 @@
+import asyncio
+import uuid
+
+import pytest
+
+from matchmaking import Matchmaker
+
+
+def make_matchmaker(widen_after=60, search_timeout=0):
+    matchmaker = Matchmaker(uuid.uuid4)
+    matchmaker.WIDEN_AFTER = widen_after
+    matchmaker.SEARCH_TIMEOUT = search_timeout
+    return matchmaker
+
+
+async def start(matchmaker, tags=(), user_id=None):
+    """ Starts search in the background and lets it reach the matchmaker """
+    task = asyncio.create_task(matchmaker.start_search_and_wait(user_id or uuid.uuid4(), tags))
+    await asyncio.sleep(0)
+    return task
+
+
+def test_users_sharing_a_tag_are_matched():
+    async def run():
+        matchmaker = make_matchmaker()
+        waiting = await start(matchmaker, ["Music", "cats"])
+        chat_id = await matchmaker.start_search_and_wait(uuid.uuid4(), [" CATS "])
+        assert await waiting == chat_id
+        assert len(matchmaker) == 0
+        assert matchmaker.buckets == {}
+    asyncio.run(run())
+
+
+def test_users_without_shared_tags_keep_waiting():
+    async def run():
+        matchmaker = make_matchmaker()
+        first = await start(matchmaker, ["music"])
+        second = await start(matchmaker, ["cats"])
+        await asyncio.sleep(0.01)
+        assert not first.done() and not second.done()
+        assert len(matchmaker) == 2
+        first.cancel()
+        second.cancel()
+    asyncio.run(run())
+
+
+def test_blank_tags_mean_anyone():
+    async def run():
+        matchmaker = make_matchmaker()
+        waiting = await start(matchmaker, ["", " "])
+        chat_id = await matchmaker.start_search_and_wait(uuid.uuid4(), ["music"])
+        assert await waiting == chat_id
+    asyncio.run(run())
+
+
+def test_longest_waiting_user_is_matched_first():
+    async def run():
+        matchmaker = make_matchmaker()
+        oldest = await start(matchmaker, ["music"])
+        newer = await start(matchmaker, ["cats"])
+        chat_id = await matchmaker.start_search_and_wait(uuid.uuid4(), ["cats", "music"])
+        assert await oldest == chat_id
+        assert not newer.done()
+        newer.cancel()
+    asyncio.run(run())
+
+
+def test_waiter_accepts_anyone_after_widening():
+    async def run():
+        matchmaker = make_matchmaker(widen_after=0.01)
+        first = await start(matchmaker, ["music"])
+        second = await start(matchmaker, ["cats"])
+        chat_ids = await asyncio.wait_for(asyncio.gather(first, second), 1)
+        assert chat_ids[0] == chat_ids[1] is not None
+        assert len(matchmaker) == 0
+    asyncio.run(run())
+
+
+def test_widened_waiter_keeps_its_tags():
+    async def run():
+        matchmaker = make_matchmaker(widen_after=0.01)
+        waiting = await start(matchmaker, ["music"])
+        await asyncio.sleep(0.05)
+        assert matchmaker.waiters[next(iter(matchmaker.waiters))].tags == {"music", Matchmaker.ANY}
+        chat_id = await matchmaker.start_search_and_wait(uuid.uuid4(), [])
+        assert await waiting == chat_id
+    asyncio.run(run())
+
+
+def test_cancelled_search_is_withdrawn():
+    async def run():
+        matchmaker = make_matchmaker(widen_after=0.01)
+        waiting = await start(matchmaker, ["music"])
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert len(matchmaker) == 0
+        assert matchmaker.buckets == {}
+
+        # Nobody is matched with the withdrawn user, neither by tag nor after widening
+        other = await start(matchmaker, ["music"])
+        await asyncio.sleep(0.05)
+        assert not other.done()
+        other.cancel()
+    asyncio.run(run())
+
+
+def test_aborted_search_returns_none():
+    async def run():
+        matchmaker = make_matchmaker()
+        user_id = uuid.uuid4()
+        waiting = await start(matchmaker, user_id=user_id)
+        matchmaker.abort_search(user_id)
+        assert await waiting is None
+        with pytest.raises(Matchmaker.WasNotSearchingError):
+            matchmaker.abort_search(user_id)
+    asyncio.run(run())
+
+
+def test_user_can_not_search_twice():
+    async def run():
+        matchmaker = make_matchmaker()
+        user_id = uuid.uuid4()
+        waiting = await start(matchmaker, user_id=user_id)
+        with pytest.raises(Matchmaker.AlreadySearchingError):
+            await matchmaker.start_search_and_wait(user_id)
+        waiting.cancel()
+    asyncio.run(run())
+
+
+def test_search_times_out_and_is_withdrawn():
+    async def run():
+        matchmaker = make_matchmaker(search_timeout=0.01)
+        with pytest.raises(Matchmaker.SearchTimeoutError):
+            await matchmaker.start_search_and_wait(uuid.uuid4(), ["music"])
+        assert len(matchmaker) == 0
+        assert matchmaker.buckets == {}
+    asyncio.run(run())
+
+
+def test_failed_searches_raise_timeout():
+    async def run():
+        matchmaker = make_matchmaker()
+        waiting = [await start(matchmaker, [tag]) for tag in ("music", "cats")]
+        matchmaker.fail_all()
+        for task in waiting:
+            with pytest.raises(Matchmaker.SearchTimeoutError):
+                await task
+        assert len(matchmaker) == 0
+    asyncio.run(run())
+
+
+def test_wait_time_of_matched_user_is_observed():
+    async def run():
+        matchmaker = make_matchmaker()
+        waiting = await start(matchmaker)
+        await matchmaker.start_search_and_wait(uuid.uuid4())
+        await waiting
+        assert matchmaker.wait_times.count == 1
+    asyncio.run(run())
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import uuid
+
+from chat import Chat
+from chat_cache import ChatCache
+from message_store import MessageStore
+
+ALICE = uuid.UUID(int=1)
+BOB = uuid.UUID(int=2)
+
+
+def make_store(count, start=1):
+    store = MessageStore()
+    for message_id in range(start, start + count):
+        store.append(message_id, (ALICE if message_id % 2 else BOB), f"text {message_id}")
+    return store
+
+
+def decode(frame):
+    return [(message["message_id"], message["from"], message["text"]) for message in json.loads(frame)]
+
+
+def test_rows_keep_order_and_authors():
+    store = make_store(3)
+    assert list(store) == [(1, ALICE, "text 1"), (2, BOB, "text 2"), (3, ALICE, "text 3")]
+    assert store.participants == [ALICE, BOB]
+    assert list(store.authors) == [0, 1, 0]
+
+
+def test_extend_maps_participants_of_the_other_store():
+    store = MessageStore.from_rows([(1, BOB, "first")])
+    store.extend(MessageStore.from_rows([(2, ALICE, "second"), (3, BOB, "third")]))
+    assert list(store) == [(1, BOB, "first"), (2, ALICE, "second"), (3, BOB, "third")]
+
+
+def test_slice_and_cursors():
+    store = make_store(10)
+    assert store.index_after(4) == 4
+    assert store.index_before(4) == 3
+    assert list(store.slice(2, 4)) == [(3, ALICE, "text 3"), (4, BOB, "text 4")]
+    assert list(store.slice(-2, None).ids) == [9, 10]
+
+
+def test_encode_is_from_the_user_perspective():
+    store = make_store(2)
+    assert decode(store.encode(ALICE)) == [(1, "YOU", "text 1"), (2, "ANON", "text 2")]
+    assert decode(store.encode(BOB)) == [(1, "ANON", "text 1"), (2, "YOU", "text 2")]
+    assert store.encode(ALICE, 1, 1) == "[]"
+
+
+def test_encode_escapes_text():
+    store = MessageStore.from_rows([(1, ALICE, 'quote " backslash \\ newline \n юникод')])
+    assert json.loads(store.encode(BOB))[0]["text"] == 'quote " backslash \\ newline \n юникод'
+
+
+def test_view_follows_appends_and_trimming():
+    store = make_store(5)
+    assert decode(store.encode(ALICE, 3, 5)) == [(4, "ANON", "text 4"), (5, "YOU", "text 5")]
+    store.append(6, BOB, "text 6")
+    assert decode(store.encode(ALICE, 5)) == [(6, "ANON", "text 6")]
+
+    store.drop_first(2)
+    assert list(store.ids) == [3, 4, 5, 6]
+    assert decode(store.encode(ALICE)) == decode(make_store(4, start=3).encode(ALICE))
+
+    store.drop_first(10)
+    assert len(store) == 0
+    assert store.encode(ALICE) == "[]"
+
+
+def test_view_bytes_are_counted_and_released():
+    store = make_store(100)
+    assert store.view_bytes() == 0
+    store.encode(ALICE)
+    alice_bytes = store.view_bytes()
+    assert alice_bytes > len(store.encode(ALICE))
+    store.encode(BOB)
+    assert store.view_bytes() > alice_bytes
+
+    store.drop_view(BOB)
+    assert store.view_bytes() == alice_bytes
+    store.drop_view(ALICE)
+    assert store.view_bytes() == 0
+    assert store.views == {}
+
+
+def make_chat(count):
+    chat = Chat(uuid.uuid4(), None)
+    chat.messages = make_store(count)
+    chat.last_message_id = count
+    return chat
+
+
+def test_sweep_drops_views_over_the_budget():
+    async def run():
+        cache = ChatCache()
+        cache.MAX_VIEW_BYTES = 1
+        chat = make_chat(100)
+        chat.clients[ALICE] = None
+        chat.messages.encode(ALICE)
+        cache[chat.chat_id] = chat
+
+        await cache.sweep()
+        assert chat.chat_id in cache
+        assert chat.messages.views == {}
+        assert cache.get_stats()["dropped_views"] == 1
+        assert cache.get_stats()["view_bytes"] == 0
+    asyncio.run(run())
+
+
+def test_sweep_evicts_idle_chats_over_the_message_budget():
+    async def run():
+        cache = ChatCache()
+        cache.MAX_MESSAGES = 150
+        idle, joined = make_chat(100), make_chat(100)
+        joined.clients[ALICE] = None
+        cache[idle.chat_id] = idle
+        cache[joined.chat_id] = joined
+
+        await cache.sweep()
+        assert idle.chat_id not in cache
+        assert joined.chat_id in cache
+        assert cache.get_stats()["evictions"] == 1
+    asyncio.run(run())
+
+
+def test_unload_keeps_chat_joined_during_the_flush():
+    async def run():
+        cache = ChatCache()
+        chat = make_chat(1)
+        cache[chat.chat_id] = chat
+        flushed = asyncio.Event()
+
+        async def slow_flush():
+            await flushed.wait()
+        chat.flush = slow_flush
+
+        unloading = asyncio.create_task(cache.unload(chat.chat_id))
+        await asyncio.sleep(0)
+        assert cache.get(chat.chat_id) is chat
+        chat.clients[ALICE] = None
+        flushed.set()
+        assert await unloading is False
+        assert chat.chat_id in cache
+
+        chat.clients.clear()
+        assert await cache.unload(chat.chat_id) is True
+        assert chat.chat_id not in cache
+    asyncio.run(run())
@@ -0,0 +1,106 @@
+import asyncio
+import uuid
+
+from profile_cache import ProfileCache
+
+USER_ID = uuid.uuid4()
+
+
+class Result:
+    def __init__(self, row):
+        self.row = row
+
+    def one_or_none(self):
+        return self.row
+
+
+class Session:
+    """ Answers every query with the given row, once the read is released """
+    def __init__(self, row, released=True):
+        self.row = row
+        self.queries = 0
+        self.released = asyncio.Event()
+        if released:
+            self.released.set()
+
+    async def execute(self, _query):
+        self.queries += 1
+        await self.released.wait()
+        return Result(self.row)
+
+
+def test_profile_is_read_once_and_cached_by_id_and_username():
+    async def run():
+        profiles = ProfileCache()
+        session = Session((USER_ID, "alice", "Alice"))
+        profile = await profiles.get(session, user_id=USER_ID)
+        assert (profile.user_id, profile.username, profile.displayed_name) == (USER_ID, "alice", "Alice")
+        assert await profiles.get(session, user_id=USER_ID) is profile
+        assert await profiles.get(session, username="alice") is profile
+        assert session.queries == 1
+    asyncio.run(run())
+
+
+def test_missing_user_is_not_cached():
+    async def run():
+        profiles = ProfileCache()
+        session = Session(None)
+        assert await profiles.get(session, username="nobody") is None
+        assert await profiles.get(session, username="nobody") is None
+        assert session.queries == 2
+    asyncio.run(run())
+
+
+def test_invalidate_forgets_old_and_new_usernames():
+    async def run():
+        profiles = ProfileCache()
+        await profiles.get(Session((USER_ID, "alice", "Alice")), user_id=USER_ID)
+        profiles.invalidate(USER_ID, "alice", "alicia")
+        assert profiles.by_user_id.get(USER_ID) is None
+        assert profiles.by_username.get("alice") is None
+    asyncio.run(run())
+
+
+def test_read_started_before_invalidation_is_not_cached():
+    async def run():
+        profiles = ProfileCache()
+        session = Session((USER_ID, "alice", "Alice"), released=False)
+        reading = asyncio.create_task(profiles.get(session, user_id=USER_ID))
+        await asyncio.sleep(0)
+
+        # User is renamed while the old row is on its way from the DB
+        profiles.invalidate(USER_ID, "alice", "alicia")
+        session.released.set()
+        assert (await reading).username == "alice"
+        assert profiles.by_user_id.get(USER_ID) is None
+        assert profiles.by_username.get("alice") is None
+        assert profiles.invalidated_at == {}
+
+        profile = await profiles.get(Session((USER_ID, "alicia", "Alice")), user_id=USER_ID)
+        assert profiles.by_user_id.get(USER_ID) is profile
+    asyncio.run(run())
+
+
+def test_read_by_username_started_before_deletion_is_not_cached():
+    async def run():
+        profiles = ProfileCache()
+        session = Session((USER_ID, "alice", "Alice"), released=False)
+        reading = asyncio.create_task(profiles.get(session, username="alice"))
+        await asyncio.sleep(0)
+        profiles.invalidate_deleted(USER_ID)
+        session.released.set()
+        await reading
+        assert profiles.by_username.get("alice") is None
+    asyncio.run(run())
+
+
+def test_invalidation_of_another_user_does_not_affect_the_read():
+    async def run():
+        profiles = ProfileCache()
+        session = Session((USER_ID, "alice", "Alice"), released=False)
+        reading = asyncio.create_task(profiles.get(session, user_id=USER_ID))
+        await asyncio.sleep(0)
+        profiles.invalidate(uuid.uuid4(), "bob")
+        session.released.set()
+        assert await reading is profiles.by_user_id.get(USER_ID)
+    asyncio.run(run())
@@ -0,0 +1,77 @@
+""" Measures first save of large in-memory chats, per-object ORM inserts against Chat.save bulk path
+
+Usage: DATABASE_URL=postgresql+asyncpg://... python tools/bench_chat_save.py [SIZE ...]
+Runs against a scratch database, the rows it creates are deleted afterwards.
+"""
+import asyncio
+import sys
+import time
+import uuid
+from os import getenv
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import delete  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+import db  # noqa: E402
+from chat import Chat  # noqa: E402
+
+
+def make_chat(session_factory, size, users):
+    chat = Chat(uuid.uuid4(), session_factory)
+    for message_id in range(1, size + 1):
+        chat.messages.append(message_id, users[message_id % 2], f"message number {message_id}")
+    chat.last_message_id = size
+    return chat
+
+
+async def save_by_objects(session_factory, chat, user_id):
+    async with session_factory() as session:
+        session.add(db.SavedChat(chat_id=chat.chat_id, user_id=user_id, title="bench"))
+        for message_id, from_id, text in chat.messages:
+            session.add(db.Message(chat_id=chat.chat_id, message_id=message_id, user_id=from_id, text=text))
+        await session.commit()
+
+
+async def save_in_bulk(session_factory, chat, user_id):
+    async with session_factory() as session:
+        await chat.save(session, user_id, "bench")
+
+
+async def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [1000, 10000, 100000]
+    url = getenv("DATABASE_URL").replace("postgres://", "postgresql+asyncpg://", 1)
+    engine = db.create_engine(url)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    async with engine.begin() as connection:
+        await connection.run_sync(db.metadata.create_all)
+
+    users = [uuid.uuid4(), uuid.uuid4()]
+    async with session_factory() as session:
+        for user_id in users:
+            session.add(db.User(user_id=user_id, username=f"bench_{user_id.hex}", password="-"))
+        await session.commit()
+
+    try:
+        for size in sizes:
+            for name, save in (("objects", save_by_objects), ("bulk", save_in_bulk)):
+                chat = make_chat(session_factory, size, users)
+                started = time.perf_counter()
+                await save(session_factory, chat, users[0])
+                elapsed = time.perf_counter() - started
+                print(f"{size:7d} messages, {name:7s}: {elapsed:8.3f}s ({size / elapsed:10.0f} messages/s)")
+    finally:
+        async with session_factory() as session:
+            await session.execute(delete(db.Message).filter(db.Message.user_id.in_(users)))
+            await session.execute(delete(db.SavedChat).filter(db.SavedChat.user_id.in_(users)))
+            await session.execute(delete(db.User).filter(db.User.user_id.in_(users)))
+            await session.commit()
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+""" Measures password verification throughput of PasswordHasher for different pool sizes
+
+Usage: python tools/bench_login_throughput.py [LOGINS] [thread|process]
+"""
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from passwords import PasswordHasher  # noqa: E402
+
+
+async def measure(pool, workers, logins):
+    hasher = PasswordHasher(pool=pool, workers=workers)
+    stored = await hasher.hash("john123")
+    try:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(hasher.verify(stored, "john123") for _ in range(logins)))
+        elapsed = time.perf_counter() - started
+    finally:
+        hasher.shutdown()
+    assert all(matches for matches, _ in results)
+    return logins / elapsed
+
+
+def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    pool = sys.argv[2] if len(sys.argv) > 2 else PasswordHasher.POOL
+
+    print(f"{logins} logins, {pool} pool, scrypt n={PasswordHasher.N} r={PasswordHasher.R} p={PasswordHasher.P}")
+    workers = 1
+    while workers <= (os.cpu_count() or 1) * 2:
+        throughput = asyncio.run(measure(pool, workers, logins))
+        print(f"{workers:3d} workers: {throughput:8.1f} logins/s")
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+""" Compares memory taken by chat messages stored as objects and in MessageStore
+
+Usage: python tools/bench_message_memory.py [MESSAGES]
+"""
+import sys
+import tracemalloc
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from message_store import MessageStore  # noqa: E402
+
+
+class ObjectMessage:
+    """ Message representation used by Chat before MessageStore """
+    def __init__(self, message_id, from_id, text):
+        self.message_id = message_id
+        self.from_id = from_id
+        self.text = text
+
+
+def generate_rows(count):
+    """ Rows like the ones coming from the DB, every row carries its own UUID object """
+    users = [uuid.uuid4(), uuid.uuid4()]
+    for message_id in range(1, count + 1):
+        yield message_id, uuid.UUID(bytes=users[message_id % 2].bytes), f"message number {message_id}"
+
+
+def measure(build, count):
+    tracemalloc.start()
+    messages = build(generate_rows(count))
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, messages
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    before, _ = measure(lambda rows: [ObjectMessage(*row) for row in rows], count)
+    after, _ = measure(MessageStore.from_rows, count)
+
+    print(f"{count} messages")
+    print(f"objects:      {before / 2 ** 20:8.2f} MiB ({before / count:6.1f} B/message)")
+    print(f"MessageStore: {after / 2 ** 20:8.2f} MiB ({after / count:6.1f} B/message)")
+    print(f"saved:        {(before - after) / before:8.1%}")
+
+
+if __name__ == '__main__':
+    main()
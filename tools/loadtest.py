@@ -0,0 +1,201 @@
+""" Drives virtual users through signup, search, chat and save flows, reports throughput and latency percentiles
+
+Usage: DATABASE_URL=postgresql://... python tools/loadtest.py [--users N] [--messages M] [--workers W]
+       python tools/loadtest.py --url http://127.0.0.1:8080 [--users N] [--messages M]
+Without --url the app is started as a subprocess on a free port and stopped afterwards. Users created by the
+run are left in the database, so run it against a scratch one.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+import aiohttp
+
+ROOT = Path(__file__).resolve().parent.parent
+MESSAGE_PREFIX = "loadtest "
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.messages = 0
+
+    def record(self, name, seconds):
+        self.latencies[name].append(seconds)
+
+    def as_dict(self, elapsed):
+        return {
+            "elapsed": elapsed,
+            "messages": self.messages,
+            "messages_per_second": self.messages / elapsed,
+            "sessions_per_second": len(self.latencies["save"]) / elapsed,
+            "errors": dict(self.errors),
+            "latency": {
+                name: {
+                    "count": len(values),
+                    "p50": percentile(values, 0.50),
+                    "p95": percentile(values, 0.95),
+                    "p99": percentile(values, 0.99),
+                }
+                for name, values in self.latencies.items()
+            },
+        }
+
+
+class VirtualUser:
+    def __init__(self, session, url, results, messages):
+        self.session = session
+        self.url = url
+        self.results = results
+        self.messages = messages
+        self.headers = None
+
+    async def timed(self, name, request):
+        started = time.perf_counter()
+        async with request as response:
+            response.raise_for_status()
+            body = await response.json()
+        self.results.record(name, time.perf_counter() - started)
+        return body
+
+    async def run(self):
+        username = "load_" + uuid.uuid4().hex[:16]
+        body = await self.timed("signup", self.session.post(
+            self.url + "/api/auth/signup", json={"displayed_name": username, "username": username, "password": "load"}))
+        self.headers = {"Authorization": "Bearer " + body["token"]}
+
+        body = await self.timed("match_wait", self.session.post(self.url + "/api/chats/start-search",
+                                                                headers=self.headers))
+        chat_id = body["chat_id"]
+
+        ws = await self.session.ws_connect(self.url.replace("http", "ws", 1) + "/api/chat/" + chat_id)
+        try:
+            await ws.send_str(self.headers["Authorization"].split()[1])
+            # Partner's messages sent before this user joined arrive with the history, not live
+            history = json.loads(await ws.receive_str())
+            early = sum(1 for message in history
+                        if message["from"] == "ANON" and message["text"].startswith(MESSAGE_PREFIX))
+            self.results.messages += early
+            await asyncio.gather(self.send(ws), self.receive(ws, early))
+            await self.timed("save", self.session.post(self.url + f"/api/chat/{chat_id}/save",
+                                                       json={"title": "load"}, headers=self.headers))
+        finally:
+            await ws.close()
+
+    async def send(self, ws):
+        for number in range(self.messages):
+            await ws.send_str(f"{MESSAGE_PREFIX}{time.perf_counter()} {number}")
+
+    async def receive(self, ws, received):
+        while received < self.messages:
+            text = await ws.receive_str()
+            if not text.startswith(MESSAGE_PREFIX):
+                continue
+            sent_at = float(text[len(MESSAGE_PREFIX):].split()[0])
+            self.results.record("delivery", time.perf_counter() - sent_at)
+            self.results.messages += 1
+            received += 1
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app(port, workers):
+    env = dict(os.environ, PORT=str(port), HOST="127.0.0.1")
+    return subprocess.Popen([sys.executable, "main.py", "--workers", str(workers)], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+async def wait_until_ready(session, url, timeout=30):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        try:
+            async with session.get(url + "/api/openapi.json"):
+                return
+        except aiohttp.ClientConnectionError:
+            if loop.time() > deadline:
+                raise
+            await asyncio.sleep(0.5)
+
+
+async def run(url, users, messages, timeout):
+    results = Results()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        await wait_until_ready(session, url)
+
+        async def run_user():
+            try:
+                await VirtualUser(session, url, results, messages).run()
+            except Exception as exc:
+                results.errors[type(exc).__name__] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user() for _ in range(users)))
+        return results.as_dict(time.perf_counter() - started)
+
+
+def print_report(report):
+    print(f"{report['elapsed']:.2f}s, {report['messages']} messages delivered, "
+          f"{report['messages_per_second']:.0f} messages/s, {report['sessions_per_second']:.1f} sessions/s")
+    for name, latency in report["latency"].items():
+        print(f"{name:12s} n={latency['count']:6d}  p50={latency['p50'] * 1000:9.2f}ms  "
+              f"p95={latency['p95'] * 1000:9.2f}ms  p99={latency['p99'] * 1000:9.2f}ms")
+    if report["errors"]:
+        print("errors:", report["errors"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100, help="virtual users, paired with each other")
+    parser.add_argument("--messages", type=int, default=20, help="messages each user sends")
+    parser.add_argument("--url", help="server to test, the app is started as a subprocess if not given")
+    parser.add_argument("--workers", type=int, default=1, help="workers of the started app")
+    parser.add_argument("--timeout", type=float, default=300, help="timeout of a single request or websocket")
+    parser.add_argument("--json", metavar="FILE", help="also write the report to the file")
+    args = parser.parse_args()
+    if args.users % 2:
+        parser.error("number of users must be even, they are paired with each other")
+
+    app = None
+    url = args.url
+    if url is None:
+        port = get_free_port()
+        url = f"http://127.0.0.1:{port}"
+        app = start_app(port, args.workers)
+    try:
+        report = asyncio.run(run(url, args.users, args.messages, args.timeout))
+    finally:
+        if app is not None:
+            app.terminate()
+            app.wait(timeout=60)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+    return 1 if report["errors"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
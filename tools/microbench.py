@@ -0,0 +1,268 @@
+""" Microbenchmarks of the hot paths of Auth, Chat and Lobby, no database is needed
+
+Usage: python tools/microbench.py [--filter NAME] [--output FILE] [--baseline FILE [--tolerance 0.2]]
+Every benchmark reports the median time per operation over several rounds after a warm-up one, each round
+starts from fresh state. With --baseline the run fails when any benchmark got slower than the baseline by
+more than the tolerance, which is widened by the spread between the rounds of a noisy benchmark.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from auth import Auth, jwt_auth  # noqa: E402
+from broadcast import Outbox  # noqa: E402
+from chat import Chat  # noqa: E402
+from lobby import Lobby  # noqa: E402
+
+MIN_ROUND_SECONDS = 0.2
+# Fan-out starts a new chat after so many messages, so every round measures chats of the same size
+FANOUT_CHAT_SIZE = 1000
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def run_coroutine(coroutine):
+    """ Runs coroutine, which never suspends, without an event loop """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("Coroutine was suspended")
+
+
+class MockRequest(dict):
+    def __init__(self, headers):
+        super().__init__()
+        self.headers = headers
+
+
+class MockWebSocket:
+    closed = False
+
+    async def send_str(self, frame):
+        pass
+
+
+def make_chat(size, users):
+    chat = Chat(uuid.uuid4(), None)
+    for message_id in range(1, size + 1):
+        chat.messages.append(message_id, users[message_id % 2], f"message number {message_id}")
+    chat.last_message_id = size
+    return chat
+
+
+# Each benchmark takes number of operations and returns elapsed seconds
+
+@benchmark("auth_verify_cached")
+def bench_verify_cached(count):
+    token = Auth.issue_token(uuid.uuid4())
+    Auth.verify(token)
+    started = time.perf_counter()
+    for _ in range(count):
+        Auth.verify(token)
+    return time.perf_counter() - started
+
+
+@benchmark("auth_verify_uncached")
+def bench_verify_uncached(count):
+    token = Auth.issue_token(uuid.uuid4())
+    started = time.perf_counter()
+    for _ in range(count):
+        Auth.verified_tokens.pop(token)
+        Auth.verify(token)
+    return time.perf_counter() - started
+
+
+@benchmark("jwt_auth_wrapper")
+def bench_jwt_auth(count):
+    async def handler(request):
+        return request["user_id"]
+
+    wrapped = jwt_auth(handler)
+    request = MockRequest({"Authorization": "Bearer " + Auth.issue_token(uuid.uuid4())})
+    run_coroutine(wrapped(request))
+    started = time.perf_counter()
+    for _ in range(count):
+        run_coroutine(wrapped(request))
+    return time.perf_counter() - started
+
+
+@benchmark("message_raw_from_user_perspective")
+def bench_raw_message(count):
+    user_id = uuid.uuid4()
+    message = Chat.Message(1, user_id, "hello there")
+    started = time.perf_counter()
+    for _ in range(count):
+        message.raw_from_user_perspective(user_id)
+    return time.perf_counter() - started
+
+
+@benchmark("history_build_cold_500")
+def bench_history_cold(count):
+    users = [uuid.uuid4(), uuid.uuid4()]
+    chat = make_chat(500, users)
+    started = time.perf_counter()
+    for _ in range(count):
+        chat.messages.views.clear()
+        run_coroutine(chat.fetch_history(users[0]))
+    return time.perf_counter() - started
+
+
+@benchmark("history_build_warm_500")
+def bench_history_warm(count):
+    users = [uuid.uuid4(), uuid.uuid4()]
+    chat = make_chat(500, users)
+    run_coroutine(chat.fetch_history(users[0]))
+    started = time.perf_counter()
+    for _ in range(count):
+        run_coroutine(chat.fetch_history(users[0], after_id=400))
+    return time.perf_counter() - started
+
+
+def bench_fanout(clients):
+    async def run(count):
+        elapsed = 0
+        for offset in range(0, count, FANOUT_CHAT_SIZE):
+            users = [uuid.uuid4() for _ in range(clients)]
+            chat = make_chat(0, users)
+            for user_id in users:
+                chat.clients[user_id] = Outbox(MockWebSocket(), chat.broadcast_stats)
+            started = time.perf_counter()
+            for number in range(min(FANOUT_CHAT_SIZE, count - offset)):
+                await chat.handle_update(users[0], "hello there")
+                # Let writer tasks drain the outboxes, as they would between incoming frames
+                if number % 64 == 63:
+                    await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            elapsed += time.perf_counter() - started
+            for outbox in chat.clients.values():
+                outbox.close()
+        return elapsed
+    return lambda count: asyncio.run(run(count))
+
+
+BENCHMARKS["handle_update_fanout_2"] = bench_fanout(2)
+BENCHMARKS["handle_update_fanout_16"] = bench_fanout(16)
+
+
+@benchmark("lobby_search_pair_cycle")
+def bench_search_pair(count):
+    async def run():
+        lobby = Lobby(None)
+        started = time.perf_counter()
+        for _ in range(count):
+            waiting = asyncio.create_task(lobby.start_search_and_wait(uuid.uuid4()))
+            await asyncio.sleep(0)
+            chat_id = await lobby.start_search_and_wait(uuid.uuid4())
+            await waiting
+            lobby.chats.pop(chat_id)
+        return time.perf_counter() - started
+    return asyncio.run(run())
+
+
+@benchmark("lobby_search_abort_cycle")
+def bench_search_abort(count):
+    async def run():
+        lobby = Lobby(None)
+        started = time.perf_counter()
+        for _ in range(count):
+            user_id = uuid.uuid4()
+            waiting = asyncio.create_task(lobby.start_search_and_wait(user_id))
+            await asyncio.sleep(0)
+            lobby.abort_search(user_id)
+            await waiting
+        return time.perf_counter() - started
+    return asyncio.run(run())
+
+
+def measure(func, rounds):
+    """ Returns the median seconds per operation, relative spread of the rounds and the number of operations """
+    count = 1
+    while True:
+        elapsed = func(count)
+        if elapsed >= MIN_ROUND_SECONDS:
+            break
+        count *= (10 if elapsed < MIN_ROUND_SECONDS / 10 else 2)
+    func(count)  # Warm-up at the final size
+
+    # Garbage left by the previous benchmarks must not be collected during this one
+    gc.collect()
+    gc.disable()
+    try:
+        seconds = [func(count) / count for _ in range(rounds)]
+    finally:
+        gc.enable()
+    median = statistics.median(seconds)
+    quartiles = statistics.quantiles(seconds, n=4)
+    return median, (quartiles[2] - quartiles[0]) / median, count
+
+
+def compare(results, baseline, tolerance):
+    """ Returns names of the benchmarks, which got slower than the baseline by more than the tolerance """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = result["ns_per_op"] / base["ns_per_op"]
+        allowed = 1 + tolerance + max(result.get("spread", 0), base.get("spread", 0))
+        status = "REGRESSION" if ratio > allowed else "ok"
+        print(f"{name:36s} {base['ns_per_op']:12.1f} -> {result['ns_per_op']:12.1f} ns/op  x{ratio:5.2f}"
+              f" (max x{allowed:4.2f})  {status}", file=sys.stderr)
+        if status != "ok":
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filter", default="", help="run only benchmarks containing the substring")
+    parser.add_argument("--rounds", type=int, default=11)
+    parser.add_argument("--output", metavar="FILE", help="write results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown, 0.2 means 20%%")
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        seconds, spread, count = measure(func, args.rounds)
+        results[name] = {"ns_per_op": seconds * 1e9, "ops_per_second": 1 / seconds, "spread": spread, "count": count}
+        print(f"{name:36s} {seconds * 1e9:12.1f} ns/op  {1 / seconds:14.0f} ops/s  ±{spread * 100:4.1f}%",
+              file=sys.stderr)
+
+    report = {"python": platform.python_version(), "benchmarks": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["benchmarks"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("SLOWER THAN BASELINE:", ", ".join(regressions), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
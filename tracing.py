@@ -0,0 +1,92 @@
+import logging
+import random
+import time
+from contextvars import ContextVar
+from os import getenv
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = float(getenv("TRACE_SAMPLE_RATE", 0.01))
+SLOW_SECONDS = float(getenv("TRACE_SLOW_SECONDS", 1.0))
+
+current = ContextVar("trace", default=None)
+
+
+class Trace:
+    """ Timed spans of a single request, durations of the spans with the same name are summed """
+    __slots__ = ("started_at", "handler_started_at", "handler_finished_at", "spans")
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.handler_started_at = None
+        self.handler_finished_at = None
+        self.spans = {}
+
+    def add(self, name, seconds):
+        total, count = self.spans.get(name, (0.0, 0))
+        self.spans[name] = (total + seconds, count + 1)
+
+    def finish(self):
+        """ Returns total duration, time around the handler is split into validation and response validation """
+        finished_at = time.perf_counter()
+        if self.handler_started_at is not None:
+            self.add("validation", self.handler_started_at - self.started_at)
+            self.add("handler", self.handler_finished_at - self.handler_started_at)
+            self.add("response_validation", finished_at - self.handler_finished_at)
+        return finished_at - self.started_at
+
+
+class span:
+    """ Context manager adding its duration to the trace of the current request, if there is one """
+    __slots__ = ("name", "trace", "started_at")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = current.get()
+        if self.trace is not None:
+            self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        if self.trace is not None:
+            self.trace.add(self.name, time.perf_counter() - self.started_at)
+
+
+def record(name, seconds):
+    trace = current.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+def start(request):
+    """ Starts trace of the request, websocket connections are not traced """
+    if request.headers.get("Upgrade", "").lower() == "websocket":
+        return None
+    return Trace()
+
+
+def finish(trace, request):
+    """ Logs spans of sampled and slow requests """
+    total = trace.finish()
+    if total < SLOW_SECONDS and random.random() >= SAMPLE_RATE:
+        return
+    spans = " ".join(f"{name}={seconds * 1000:.2f}ms" + (f"/{count}" if count > 1 else "")
+                     for name, (seconds, count) in trace.spans.items())
+    logger.info("TRACE %s %s total=%.2fms %s", request.method, request.path, total * 1000, spans)
+
+
+@web.middleware
+async def middleware(request, handler):
+    """ Innermost middleware, marks where OpenAPI validation ends and the handler starts """
+    trace = current.get()
+    if trace is None:
+        return await handler(request)
+    trace.handler_started_at = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        trace.handler_finished_at = time.perf_counter()
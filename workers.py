@@ -0,0 +1,120 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import tempfile
+import time
+from os import getenv
+
+from aiohttp import web
+
+from hub import run_hub
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(create_app, host, port, hub_path, run_app_kwargs):
+    # Ctrl+C reaches the master only, which drains the workers with SIGTERM
+    os.setpgrp()
+    os.environ["CLUSTER_HUB"] = hub_path
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    web.run_app(create_app(), sock=sock, **run_app_kwargs)
+
+
+class Supervisor:
+    """ Runs the hub process with the matchmaker and HTTP workers sharing one port through SO_REUSEPORT
+
+    Workers reach each other through the hub, so participants of a chat may be served by different workers.
+    """
+    HUB_SOCKET = getenv("HUB_SOCKET")
+    HUB_START_TIMEOUT = 10
+    RESTART_DELAY = 1
+
+    def __init__(self, create_app, workers, host, port, run_app_kwargs):
+        self.create_app = create_app
+        self.workers_count = workers
+        self.host = host
+        self.port = int(port)
+        self.run_app_kwargs = run_app_kwargs
+        self.hub_path = self.HUB_SOCKET or os.path.join(tempfile.gettempdir(), f"swapchad-{os.getpid()}.sock")
+        self.context = multiprocessing.get_context("fork")
+        self.hub = None
+        self.workers = []
+        self.stopping = False
+
+    def run(self):
+        self.start_hub()
+
+        self.workers = [self.start_worker(number) for number in range(self.workers_count)]
+        logger.info("MASTER: STARTED %d WORKERS ON %s:%d", self.workers_count, self.host, self.port)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping:
+            multiprocessing.connection.wait([self.hub.sentinel] + [worker.sentinel for worker in self.workers],
+                                            timeout=1)
+            # Workers reconnect to the new hub by themselves and restore their locks there
+            if not self.hub.is_alive() and not self.stopping:
+                logger.error("MASTER: HUB EXITED WITH CODE %s, RESTARTING", self.hub.exitcode)
+                time.sleep(self.RESTART_DELAY)
+                self.start_hub()
+            for number, worker in enumerate(self.workers):
+                if not worker.is_alive() and not self.stopping:
+                    logger.error("MASTER: WORKER %d EXITED WITH CODE %s, RESTARTING", number, worker.exitcode)
+                    time.sleep(self.RESTART_DELAY)
+                    self.workers[number] = self.start_worker(number)
+
+        self.drain()
+
+    def start_hub(self):
+        # Socket of the crashed hub is left behind, it must not be taken for the new one
+        if os.path.exists(self.hub_path):
+            os.unlink(self.hub_path)
+        self.hub = self.context.Process(target=run_hub, args=(self.hub_path,), name="hub")
+        self.hub.start()
+        self.wait_for_hub()
+
+    def wait_for_hub(self):
+        deadline = time.monotonic() + self.HUB_START_TIMEOUT
+        while not os.path.exists(self.hub_path):
+            if not self.hub.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("Hub process has not started")
+            time.sleep(0.05)
+
+    def start_worker(self, number):
+        worker = self.context.Process(
+            target=run_worker,
+            args=(self.create_app, self.host, self.port, self.hub_path, self.run_app_kwargs),
+            name=f"worker-{number}",
+        )
+        worker.start()
+        return worker
+
+    def stop(self, _signum=None, _frame=None):
+        self.stopping = True
+
+    def drain(self):
+        """ Lets workers close their connections gracefully, then stops the hub """
+        logger.info("MASTER: DRAINING WORKERS")
+        for worker in self.workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.run_app_kwargs.get("shutdown_timeout", 60) + 5
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+            if worker.is_alive():
+                logger.error("MASTER: WORKER %s WAS NOT DRAINED IN TIME, KILLING", worker.name)
+                worker.kill()
+                worker.join()
+
+        self.hub.terminate()
+        self.hub.join()
+        logger.info("MASTER: STOPPED")